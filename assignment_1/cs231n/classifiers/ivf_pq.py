@@ -0,0 +1,332 @@
+from __future__ import print_function
+
+import time
+
+import numpy as np
+from past.builtins import xrange
+
+
+# arrays that hold the state of a built IVFPQIndex
+INDEX_ARRAYS = ('coarse_centroids', 'pq_centroids', 'order', 'codes', 'code_terms',
+                'list_offsets')
+
+# number of queries searched, or vectors encoded, at a time; larger blocks
+# share the decoding of every inverted list among more queries
+SEARCH_BLOCK_SIZE = 1024
+
+
+def kmeans(X, num_clusters, num_iters=10, seed=0):
+    """
+    Plain Lloyd's k-means with squared L2 distance.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) containing the points to cluster.
+    - num_clusters: Number of centroids K.
+    - num_iters: Number of assignment / update steps.
+    - seed: Seed for choosing the initial centroids.
+
+    Returns a tuple of:
+    - centroids: A numpy array of shape (K, D)
+    - assignments: A numpy array of shape (N,) giving the centroid of each point
+    """
+    rng = np.random.RandomState(seed)
+    N = X.shape[0]
+    num_clusters = min(num_clusters, N)
+    centroids = X[rng.choice(N, num_clusters, replace=False)].astype(np.float64)
+    for it in xrange(num_iters):
+        assignments = _nearest_centroid(X, centroids)
+        counts = np.bincount(assignments, minlength=num_clusters)
+        empty = counts == 0
+        # sum the points of every cluster with one reduceat over sorted rows
+        order = np.argsort(assignments, kind='mergesort')
+        starts = np.cumsum(counts) - counts
+        sums = np.add.reduceat(X[order], starts[~empty], axis=0)
+        centroids[~empty] = sums / counts[~empty, None]
+        # restart empty clusters from random points
+        centroids[empty] = X[rng.choice(N, np.sum(empty))]
+    return centroids, _nearest_centroid(X, centroids)
+
+
+def _nearest_centroid(X, centroids):
+    dists = np.sum(np.square(centroids), axis=1) - 2 * X.dot(centroids.T)
+    return np.argmin(dists, axis=1)
+
+
+class IVFPQIndex(object):
+    """
+    An approximate nearest-neighbor index: an inverted file over a coarse
+    k-means partition of the training set, with the residual of every vector
+    to its coarse centroid compressed by product quantization.
+
+    At search time only the nprobe inverted lists whose centroids are closest
+    to the query are scanned. Queries are searched in blocks: the PQ codes of
+    every probed list are decoded into full D-dimensional residuals once per
+    block, and the distances from all the queries probing the list to them
+    are one GEMM. Every candidate thus costs O(D), as in an exact search, and
+    the work is about nprobe / num_lists of an exact search; the PQ codes save
+    memory, not arithmetic.
+    """
+
+    def __init__(self, num_lists=100, num_subvectors=8, num_codes=256,
+                 nprobe=8, num_iters=10, max_train_points=20000, seed=0):
+        """
+        Inputs:
+        - num_lists: Number of coarse centroids / inverted lists.
+        - num_subvectors: Number of PQ subvectors M; D must be divisible by M.
+        - num_codes: Number of centroids per PQ subquantizer, at most 256 so
+          that every code fits in a uint8.
+        - nprobe: Default number of inverted lists scanned per query.
+        - num_iters: Number of k-means iterations for every quantizer.
+        - max_train_points: The quantizers are learned on a random subset of
+          at most this many training points.
+        - seed: Random seed used when learning the quantizers.
+        """
+        assert num_codes <= 256, 'PQ codes are stored as uint8'
+        self.num_lists = num_lists
+        self.num_subvectors = num_subvectors
+        self.num_codes = num_codes
+        self.nprobe = nprobe
+        self.num_iters = num_iters
+        self.max_train_points = max_train_points
+        self.seed = seed
+
+    def build(self, X):
+        """
+        Learn the coarse and product quantizers and encode X.
+
+        Inputs:
+        - X: A numpy array of shape (N, D) containing the vectors to index.
+        """
+        N, D = X.shape
+        M = self.num_subvectors
+        if D % M != 0:
+            raise ValueError('Dimension %d is not divisible by %d subvectors' % (D, M))
+        rng = np.random.RandomState(self.seed)
+        sample = X
+        if N > self.max_train_points:
+            sample = X[np.sort(rng.choice(N, self.max_train_points, replace=False))]
+        sample = sample.astype(np.float64)
+
+        self.coarse_centroids, _ = kmeans(sample, self.num_lists,
+                                          self.num_iters, self.seed)
+        sample_lists = _nearest_centroid(sample, self.coarse_centroids)
+        residuals = sample - self.coarse_centroids[sample_lists]
+
+        dsub = D // M
+        self.pq_centroids = np.zeros((M, self.num_codes, dsub))
+        for m in xrange(M):
+            centroids, _ = kmeans(np.ascontiguousarray(residuals[:, m * dsub:(m + 1) * dsub]),
+                                  self.num_codes, self.num_iters, self.seed + m + 1)
+            # k-means returns fewer centroids when there are fewer points, so
+            # pad with repeats of the first one
+            self.pq_centroids[m] = centroids[0]
+            self.pq_centroids[m, :centroids.shape[0]] = centroids
+
+        # Encode every vector and group the codes by inverted list
+        lists = _nearest_centroid(X, self.coarse_centroids)
+        codes = self.encode(X - self.coarse_centroids[lists])
+        self.order = np.argsort(lists, kind='mergesort')
+        self.codes = codes[self.order]
+        self.code_terms = self._code_terms(lists, codes)[self.order]
+        self.list_offsets = np.zeros(self.coarse_centroids.shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lists, minlength=self.coarse_centroids.shape[0]),
+                  out=self.list_offsets[1:])
+
+    def add(self, X, start):
+        """
+        Encode new vectors with the existing quantizers and insert them into
+        their inverted lists, without retraining.
+
+        Inputs:
+        - X: A numpy array of shape (num_new, D) containing the new vectors.
+        - start: Index of the first new vector in the indexed data.
+        """
+        num_lists = self.coarse_centroids.shape[0]
+        lists = _nearest_centroid(X, self.coarse_centroids)
+        codes = self.encode(X - self.coarse_centroids[lists])
+        old_lists = np.repeat(np.arange(num_lists), np.diff(self.list_offsets))
+        all_lists = np.concatenate((old_lists, lists))
+        merge = np.argsort(all_lists, kind='mergesort')
+        self.codes = np.concatenate((self.codes, codes))[merge]
+        self.code_terms = np.concatenate(
+            (self.code_terms, self._code_terms(lists, codes)))[merge]
+        self.order = np.concatenate((self.order, start + np.arange(X.shape[0])))[merge]
+        self.list_offsets = self.list_offsets.copy()
+        self.list_offsets[1:] += np.cumsum(np.bincount(lists, minlength=num_lists))
+
+    def get_params(self):
+        """ Return the constructor arguments of this index as a dictionary. """
+        return {
+            'num_lists': self.num_lists,
+            'num_subvectors': self.num_subvectors,
+            'num_codes': self.num_codes,
+            'nprobe': self.nprobe,
+            'num_iters': self.num_iters,
+            'max_train_points': self.max_train_points,
+            'seed': self.seed,
+        }
+
+    def encode(self, residuals):
+        """
+        Product-quantize residual vectors of shape (N, D) into uint8 codes of
+        shape (N, M).
+        """
+        M, _, dsub = self.pq_centroids.shape
+        codes = np.zeros((residuals.shape[0], M), dtype=np.uint8)
+        for m in xrange(M):
+            codes[:, m] = _nearest_centroid(residuals[:, m * dsub:(m + 1) * dsub],
+                                            self.pq_centroids[m])
+        return codes
+
+    def search(self, X, k=1, nprobe=None):
+        """
+        Find approximate k nearest neighbors of every row of X.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing query points.
+        - k: Number of neighbors to return.
+        - nprobe: Number of inverted lists to scan per query; defaults to the
+          value given to the constructor. Larger is slower but more accurate.
+          A query whose nprobe closest lists hold fewer than k vectors probes
+          further lists until it has k candidates.
+
+        Returns a tuple of:
+        - dists: A numpy array of shape (num_test, k) of approximate squared L2
+          distances, sorted in increasing order.
+        - idxs: A numpy array of shape (num_test, k) of indices into the indexed
+          data. Only if the whole index holds fewer than k vectors are the
+          remaining slots filled with -1 (and their distances with inf).
+        """
+        if nprobe is None:
+            nprobe = self.nprobe
+        num_test = X.shape[0]
+        dists = np.zeros((num_test, k))
+        idxs = np.zeros((num_test, k), dtype=np.int64)
+        for i in xrange(0, num_test, SEARCH_BLOCK_SIZE):
+            dists[i:i + SEARCH_BLOCK_SIZE], idxs[i:i + SEARCH_BLOCK_SIZE] = \
+                self._search_block(X[i:i + SEARCH_BLOCK_SIZE], k, nprobe)
+        return dists, idxs
+
+    def _search_block(self, X, k, nprobe):
+        """
+        Search for a block of queries at once. With x a query, c the centroid
+        of a list and p the PQ reconstruction of a residual in it,
+
+          ||x - c - p||^2 = ||x - c||^2 + (||p||^2 + 2 <c, p>) - 2 <x, p>
+
+        The first term is the coarse distance and the second is code_terms,
+        stored per vector at build time. The scan loops over inverted lists,
+        not over queries: the residuals of a list are decoded once per block
+        and the last term for every query probing the list is one GEMM, so
+        the work is about nprobe / num_lists of an exact search.
+        """
+        num_test = X.shape[0]
+        num_lists = self.coarse_centroids.shape[0]
+        M, num_codes, dsub = self.pq_centroids.shape
+        sizes = np.diff(self.list_offsets)
+
+        coarse_dists = (np.sum(np.square(X), axis=1, keepdims=True)
+                        + np.sum(np.square(self.coarse_centroids), axis=1)
+                        - 2 * X.dot(self.coarse_centroids.T))
+        order = np.argsort(coarse_dists, axis=1)
+        ranks = np.empty_like(order)
+        ranks[np.arange(num_test)[:, None], order] = np.arange(num_lists)
+        # probe more lists where the nprobe closest hold fewer than k vectors
+        needed = np.sum(np.cumsum(sizes[order], axis=1) < k, axis=1) + 1
+        num_probes = np.minimum(np.maximum(needed, nprobe), num_lists)
+        probed = ranks < num_probes[:, None]
+
+        # PQ centroids as rows, so that decoding a list is a single take
+        pq_rows = self.pq_centroids.reshape(M * num_codes, dsub)
+        code_offsets = num_codes * np.arange(M)
+
+        # the best k candidates of every probed list go to one slot per probe
+        cand_dists = np.full((num_test, np.max(num_probes) * k), np.inf)
+        cand_idxs = np.full(cand_dists.shape, -1, dtype=np.int64)
+        for l in np.nonzero(sizes)[0]:
+            queries = np.nonzero(probed[:, l])[0]
+            if queries.size == 0:
+                continue
+            start, end = self.list_offsets[l], self.list_offsets[l + 1]
+            recon = pq_rows.take(self.codes[start:end] + code_offsets, axis=0)
+            recon = recon.reshape(end - start, -1)
+            list_dists = (coarse_dists[queries, l][:, None] + self.code_terms[start:end]
+                          - 2 * X[queries].dot(recon.T))
+            num_found = min(k, end - start)
+            top = np.argpartition(list_dists, num_found - 1, axis=1)[:, :num_found]
+            slots = ranks[queries, l][:, None] * k + np.arange(num_found)
+            cand_dists[queries[:, None], slots] = list_dists[np.arange(queries.size)[:, None], top]
+            cand_idxs[queries[:, None], slots] = self.order[start + top]
+
+        best = np.argsort(cand_dists, axis=1, kind='mergesort')[:, :k]
+        rows = np.arange(num_test)[:, None]
+        return cand_dists[rows, best], cand_idxs[rows, best]
+
+    def _code_terms(self, lists, codes):
+        """
+        Return ||p||^2 + 2 <c, p> for every encoded vector, where c is the
+        centroid of its list and p the PQ reconstruction of its residual.
+        """
+        M, _, dsub = self.pq_centroids.shape
+        terms = np.zeros(codes.shape[0])
+        for j in xrange(0, codes.shape[0], SEARCH_BLOCK_SIZE):
+            block = codes[j:j + SEARCH_BLOCK_SIZE]
+            recon = self.pq_centroids[np.arange(M), block] # (n, M, dsub)
+            centroids = self.coarse_centroids[lists[j:j + SEARCH_BLOCK_SIZE]]
+            terms[j:j + SEARCH_BLOCK_SIZE] = (
+                np.sum(np.square(recon), axis=(1, 2))
+                + 2 * np.sum(centroids.reshape(recon.shape) * recon, axis=(1, 2)))
+        return terms
+
+
+def recall_latency_report(classifier, X, k=10, nprobes=(1, 2, 4, 8, 16, 32),
+                          verbose=True):
+    """
+    Compare approximate search through classifier.index against the exact
+    compute_distances_no_loops path.
+
+    Inputs:
+    - classifier: A KNearestNeighbor trained with an IVFPQIndex.
+    - X: A numpy array of shape (num_test, D) of query points.
+    - k: Number of neighbors used for recall@k and for label votes.
+    - nprobes: Values of nprobe to evaluate.
+    - verbose: If true, print one line per setting.
+
+    Returns:
+    A list of dictionaries, one for the exact search (nprobe None) and one per
+    nprobe, with keys 'nprobe', 'recall', 'label_agreement' and 'ms_per_query'.
+    Recall is the fraction of the exact k nearest neighbors that are found,
+    and label agreement the fraction of predictions that match exact kNN.
+    """
+    num_test = X.shape[0]
+    # time the same work on both sides: from queries to the sorted k nearest
+    # indices; voting is left out of both
+    tic = time.time()
+    dists = classifier.compute_distances_no_loops(X)
+    exact_idxs = np.argpartition(dists, k - 1, axis=1)[:, :k]
+    rows = np.arange(num_test)[:, None]
+    exact_idxs = exact_idxs[rows, np.argsort(dists[rows, exact_idxs], axis=1)]
+    exact_time = time.time() - tic
+    exact_labels = classifier.predict_labels(dists, k=k)
+
+    results = [{'nprobe': None, 'recall': 1.0, 'label_agreement': 1.0,
+                'ms_per_query': 1000.0 * exact_time / num_test}]
+    for nprobe in nprobes:
+        tic = time.time()
+        _, idxs = classifier.index.search(X, k=k, nprobe=nprobe)
+        elapsed = time.time() - tic
+        labels = classifier.predict(X, k=k, nprobe=nprobe)
+        hits = sum(np.intersect1d(idxs[i], exact_idxs[i]).size for i in xrange(num_test))
+        results.append({
+            'nprobe': nprobe,
+            'recall': float(hits) / (num_test * k),
+            'label_agreement': np.mean(labels == exact_labels),
+            'ms_per_query': 1000.0 * elapsed / num_test,
+        })
+
+    if verbose:
+        for r in results:
+            name = 'exact' if r['nprobe'] is None else 'nprobe=%d' % r['nprobe']
+            print('%-10s recall@%d %.4f  label agreement %.4f  %.3f ms/query' % (
+                  name, k, r['recall'], r['label_agreement'], r['ms_per_query']))
+    return results
@@ -1,14 +1,39 @@
+import atexit
+import json
+import os
+import shutil
+import time
+
 import numpy as np
 from past.builtins import xrange
 
+from cs231n.classifiers.ivf_pq import INDEX_ARRAYS, IVFPQIndex
+from cs231n.parallel import shared_tmpdir, spawn_pool
+
+
+STORAGE_DTYPES = {
+    'float64': np.float64,
+    'float32': np.float32,
+    'float16': np.float16,
+    'int8': np.int8,
+}
+
+METRICS = ('l2', 'l1', 'cosine')
+
+# number of training rows decoded at a time for compact storage modes
+TRAIN_BLOCK_SIZE = 4096
+
+# max number of elements in the (test, train, D) differences of one L1 block
+L1_BLOCK_ELEMENTS = 2 ** 22
+
 
 class KNearestNeighbor(object):
-    """ a kNN classifier with L2 distance """
+    """ a kNN classifier with L2, L1 or cosine distance """
 
     def __init__(self):
         pass
 
-    def train(self, X, y):
+    def train(self, X, y, index=None, storage='float64', metric='l2'):
         """
         Train the classifier. For k-nearest neighbors this is just
         memorizing the training data.
@@ -18,11 +43,174 @@ class KNearestNeighbor(object):
           consisting of num_train samples each of dimension D.
         - y: A numpy array of shape (N,) containing the training labels, where
              y[i] is the label for X[i].
+        - index: Optional approximate nearest-neighbor index such as an
+          IVFPQIndex. If given it is built over X here and predict searches it
+          instead of comparing against every training point.
+        - storage: How the training data is kept in memory; one of 'float64'
+          (a reference to X, as is), 'float32', 'float16', or 'int8' (rows
+          quantized to [-127, 127] with one float scale per row). The compact
+          modes use 2-8x less memory; compute_distances_no_loops runs its GEMM
+          in float32 against them.
+        - metric: Distance used by compute_distances_no_loops; one of 'l2',
+          'l1' or 'cosine'. For cosine the training rows are normalized here
+          so that distances reduce to a single GEMM.
         """
-        self.X_train = X
+        if storage not in STORAGE_DTYPES:
+            raise ValueError('Invalid storage "%s"' % storage)
+        if metric not in METRICS:
+            raise ValueError('Invalid metric "%s"' % metric)
+        if index is not None and metric != 'l2':
+            raise ValueError('Approximate indexes only support the l2 metric')
+        self.storage = storage
+        self.metric = metric
+        if metric == 'cosine':
+            X = _normalize_rows(X)
+        self.X_train, self.train_scale = self._encode(X)
         self.y_train = y
+        self.index = index
+        self._drop_shared_train()
+        self._path = None
+        self._train_file = None
+        if index is not None:
+            index.build(X)
+
+        # squared norms of the stored training rows, computed once here rather
+        # than on every predict call
+        self.train_sq = self._squared_norms(self.X_train, self.train_scale)
+
+    def add(self, X, y):
+        """
+        Append new labelled points without retraining. The points are stored
+        with the same storage mode and metric as the training data, and added
+        to the approximate index, if any, using its existing quantizers. If
+        the classifier was loaded from disk with mmap=True, the arrays on disk
+        are extended: every one is copied block by block to a new file
+        followed by the new rows, so the existing data is never read into
+        memory at once, and meta.json is switched to the new files only once
+        all of them are written. If writing fails, the directory and this
+        classifier are left as they were.
+
+        Inputs:
+        - X: A numpy array of shape (num_new, D) containing the new points.
+        - y: A numpy array of shape (num_new,) containing their labels.
+        """
+        if self.metric == 'cosine':
+            X = _normalize_rows(X)
+        rows, scale = self._encode(X)
+        new = {
+            'X_train': rows,
+            'y_train': np.asarray(y, dtype=self.y_train.dtype),
+            'train_sq': self._squared_norms(rows, scale),
+        }
+        if scale is not None:
+            new['train_scale'] = scale
+        if self.index is not None:
+            # index.add replaces its arrays rather than changing them in place
+            index_arrays = dict((name, getattr(self.index, name)) for name in INDEX_ARRAYS)
+            self.index.add(X, start=self.X_train.shape[0])
+        self._drop_shared_train()
+
+        if self._path is not None:
+            old_meta = _read_meta(self._path)
+            meta = dict(old_meta, arrays=dict(old_meta['arrays']),
+                        generation=old_meta['generation'] + 1)
+            try:
+                for name, arr in new.items():
+                    _append_array(self._path, name, arr, meta, old_meta)
+                if self.index is not None:
+                    for name in INDEX_ARRAYS:
+                        _write_array(self._path, 'index_' + name, getattr(self.index, name), meta)
+            except Exception:
+                _remove_arrays(self._path, meta, keep=old_meta)
+                if self.index is not None:
+                    for name, arr in index_arrays.items():
+                        setattr(self.index, name, arr)
+                raise
+            _write_meta(self._path, meta)
+            _remove_arrays(self._path, old_meta, keep=meta)
+            self._open_arrays(self._path, meta, mmap=True)
+        else:
+            for name, arr in new.items():
+                setattr(self, name, np.concatenate((getattr(self, name), arr)))
 
-    def predict(self, X, k=1, num_loops=0):
+    def save(self, path):
+        """
+        Persist the classifier to the directory path: training vectors, labels,
+        norms, quantization scales and any index structures are written as .npy
+        files that load can memory-map, plus a meta.json file naming them.
+        Every save writes new files and replaces meta.json atomically before
+        removing the old ones, so saving over a directory that is currently
+        mapped is safe.
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        old_meta = None
+        if os.path.exists(os.path.join(path, 'meta.json')):
+            old_meta = _read_meta(path)
+        meta = {'storage': self.storage, 'metric': self.metric, 'arrays': {},
+                'index': None,
+                'generation': 0 if old_meta is None else old_meta['generation'] + 1}
+        arrays = {'X_train': self.X_train, 'y_train': self.y_train,
+                  'train_sq': self.train_sq}
+        if self.train_scale is not None:
+            arrays['train_scale'] = self.train_scale
+        if self.index is not None:
+            meta['index'] = self.index.get_params()
+            for name in INDEX_ARRAYS:
+                arrays['index_' + name] = getattr(self.index, name)
+        try:
+            for name, arr in arrays.items():
+                _write_array(path, name, arr, meta)
+        except Exception:
+            _remove_arrays(path, meta, keep=old_meta)
+            raise
+        _write_meta(path, meta)
+        if self._path is not None and os.path.abspath(path) == os.path.abspath(self._path):
+            # the files mapped so far are about to be removed
+            self._open_arrays(path, meta, mmap=True)
+        if old_meta is not None:
+            _remove_arrays(path, old_meta, keep=meta)
+
+    def load(self, path, mmap=True):
+        """
+        Load a classifier written by save, replacing the current training data.
+
+        Inputs:
+        - path: Directory given to save.
+        - mmap: If true, memory-map the arrays read-only instead of reading
+          them, so that startup is near instant and several processes opening
+          the same directory share the page cache. Later calls to add extend
+          the files on disk.
+
+        Returns:
+        This classifier, for chaining.
+        """
+        meta = _read_meta(path)
+        self.storage = meta['storage']
+        self.metric = meta['metric']
+        self.index = None
+        if meta['index'] is not None:
+            self.index = IVFPQIndex(**meta['index'])
+        self._drop_shared_train()
+        self._path = path if mmap else None
+        self._open_arrays(path, meta, mmap)
+        return self
+
+    def _open_arrays(self, path, meta, mmap):
+        arrays = dict((name, _open_array(path, name, meta, mmap))
+                      for name in meta['arrays'])
+        self.X_train = arrays['X_train']
+        # a mapped X_train is already a .npy file that workers can open
+        self._train_file = os.path.join(path, meta['arrays']['X_train']) if mmap else None
+        self.y_train = arrays['y_train']
+        self.train_sq = arrays['train_sq']
+        self.train_scale = arrays.get('train_scale')
+        if self.index is not None:
+            for name in INDEX_ARRAYS:
+                setattr(self.index, name, arrays['index_' + name])
+
+    def predict(self, X, k=1, num_loops=0, block_size=None, nprobe=None,
+                num_workers=None):
         """
         Predict labels for test data using this classifier.
 
@@ -32,11 +220,33 @@ class KNearestNeighbor(object):
         - k: The number of nearest neighbors that vote for the predicted labels.
         - num_loops: Determines which implementation to use to compute distances
           between training points and testing points.
+        - block_size: If not None, ignore num_loops and predict in streaming
+          mode, processing test and training rows in tiles of this many rows so
+          that the full (num_test, num_train) distance matrix is never built.
+        - nprobe: Number of inverted lists scanned per query when the classifier
+          was trained with an index; None uses the index default.
+        - num_workers: If not None, search the training set in parallel with
+          this many processes; see predict_parallel.
 
         Returns:
         - y: A numpy array of shape (num_test,) containing predicted labels for the
           test data, where y[i] is the predicted label for the test point X[i].
         """
+        if (self.storage == 'int8' or self.metric != 'l2') and (
+                num_loops != 0 or block_size is not None or num_workers is not None):
+            raise ValueError('Only num_loops=0 is supported with %s storage '
+                             'and the %s metric' % (self.storage, self.metric))
+        if self.index is not None:
+            _, idxs = self.index.search(X, k=k, nprobe=nprobe)
+            # vote only over the neighbors that were found
+            return _vote(self.y_train[np.maximum(idxs, 0)],
+                         weights=idxs >= 0).astype(np.float64)
+        if num_workers is not None:
+            return self.predict_parallel(X, k=k, num_workers=num_workers,
+                                         block_size=block_size or 1024)
+        if block_size is not None:
+            return self.predict_streaming(X, k=k, block_size=block_size)
+
         if num_loops == 0:
             dists = self.compute_distances_no_loops(X)
         elif num_loops == 1:
@@ -116,8 +326,15 @@ class KNearestNeighbor(object):
         Compute the distance between each test point in X and each training point
         in self.X_train using no explicit loops.
 
-        Input / Output: Same as compute_distances_two_loops
+        Input / Output: Same as compute_distances_two_loops, except that the
+        distance is the metric given to train.
         """
+        if self.metric == 'l1':
+            return self._l1_distances(X)
+        if self.metric == 'cosine':
+            # training rows are already unit length
+            return 1 - self._cross_products(_normalize_rows(X))
+
         num_test = X.shape[0]
         num_train = self.X_train.shape[0]
         dists = np.zeros((num_test, num_train))
@@ -150,7 +367,18 @@ class KNearestNeighbor(object):
         # sum_p(I_1^p * I_2^p) -> np.dot(X, self.X_train.T)/np.matmul(X, self.X_train.T)
         #
         #dists = np.sqrt(np.reshape(np.sum(X**2, axis=1), [num_test,1]) + np.sum(self.X_train**2, axis=1) - 2 * np.matmul(X, self.X_train.T))
-        dists = np.sqrt((np.sum(np.square(X), axis=1, keepdims=True) - 2 * np.dot(X, self.X_train.T)) + np.sum(np.square(self.X_train), axis=1))
+        if self.storage == 'float64':
+            dists = np.sqrt((np.sum(np.square(X), axis=1, keepdims=True) - 2 * np.dot(X, self.X_train.T)) + self.train_sq)
+        else:
+            # compact storage: build the distances in place in the float32
+            # matrix of cross products
+            X = X.astype(np.float32)
+            dists = self._cross_products(X)
+            dists *= -2
+            dists += np.sum(np.square(X), axis=1, keepdims=True)
+            dists += self.train_sq.astype(np.float32)
+            np.maximum(dists, 0, out=dists)
+            np.sqrt(dists, out=dists)
 
         #########################################################################
         #                         END OF YOUR CODE                              #
@@ -211,3 +439,414 @@ class KNearestNeighbor(object):
 
         return y_pred
 
+    def predict_streaming(self, X, k=1, block_size=1024):
+        """
+        Predict labels for test data without materializing the full distance
+        matrix. Test and training rows are processed in tiles of block_size
+        rows, and for every test point only a running top-k of (distance, index)
+        pairs is kept, so peak memory is O(block_size * (block_size + k)) no
+        matter how large the training set is.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: The number of nearest neighbors that vote for the predicted labels.
+        - block_size: Number of test rows and training rows per tile.
+
+        Returns:
+        - y: A numpy array of shape (num_test,) containing predicted labels, the
+          same as predict_labels would give on the full distance matrix.
+        """
+        _, idxs = _top_k_blocked(X, self.X_train, self.train_sq, k, block_size)
+        return _vote(self.y_train[idxs]).astype(np.float64)
+
+    def predict_parallel(self, X, k=1, num_workers=4, block_size=1024,
+                         blas_threads=1):
+        """
+        Predict labels for test data with a pool of worker processes. The
+        workers memory-map X_train from a file (see _shared_train_path) and
+        the training rows are split into one shard per worker. Every worker returns the top-k of its
+        shard and the parent merges them before voting. Workers are spawned
+        with their BLAS thread count pinned to blas_threads, so that
+        num_workers processes do not oversubscribe the cores.
+
+        Inputs:
+        - X: A numpy array of shape (num_test, D) containing test data.
+        - k: The number of nearest neighbors that vote for the predicted labels.
+        - num_workers: Number of worker processes / training shards.
+        - block_size: Tile size used inside every worker, as in
+          predict_streaming.
+        - blas_threads: Number of BLAS threads per worker.
+
+        Returns:
+        - y: A numpy array of shape (num_test,) containing predicted labels.
+        """
+        num_train = self.X_train.shape[0]
+        if num_workers < 1:
+            raise ValueError('num_workers must be at least 1, got %d' % num_workers)
+        if num_train == 0:
+            raise ValueError('Cannot predict without training data')
+        path = self._shared_train_path()
+        bounds = np.linspace(0, num_train, num_workers + 1).astype(int)
+        jobs = [(path, bounds[w], bounds[w + 1], self.train_sq[bounds[w]:bounds[w + 1]],
+                 X, k, block_size)
+                for w in xrange(num_workers) if bounds[w] < bounds[w + 1]]
+
+        pool = spawn_pool(len(jobs), blas_threads)
+        try:
+            shards = pool.map(_shard_top_k, jobs)
+        finally:
+            pool.close()
+            pool.join()
+
+        # merge in shard order so that ties still go to lower training indices
+        dists, idxs = shards[0]
+        for shard_dists, shard_idxs in shards[1:]:
+            dists, idxs = _merge_top_k(dists, idxs, shard_dists, shard_idxs, k)
+        return _vote(self.y_train[idxs]).astype(np.float64)
+
+    def _cross_products(self, X):
+        """
+        Return X.dot(X_train.T), decoding compact storage one block of
+        training rows at a time into a float32 result.
+        """
+        if self.storage == 'float64':
+            return np.dot(X, self.X_train.T)
+        num_train = self.X_train.shape[0]
+        X = X.astype(np.float32)
+        products = np.empty((X.shape[0], num_train), dtype=np.float32)
+        for j in xrange(0, num_train, TRAIN_BLOCK_SIZE):
+            rows = self._train_rows(j, j + TRAIN_BLOCK_SIZE)
+            products[:, j:j + rows.shape[0]] = np.dot(X, rows.T)
+        return products
+
+    def _l1_distances(self, X):
+        """
+        L1 distances between every row of X and every training row, computed
+        over blocks of test and training rows so that the broadcast
+        differences never exceed L1_BLOCK_ELEMENTS elements.
+        """
+        num_test, dim = X.shape
+        num_train = self.X_train.shape[0]
+        dists = np.zeros((num_test, num_train))
+        test_block = max(1, min(num_test, 8))
+        train_block = max(1, L1_BLOCK_ELEMENTS // (test_block * dim))
+        for i in xrange(0, num_test, test_block):
+            X_block = X[i:i + test_block, None, :]
+            for j in xrange(0, num_train, train_block):
+                rows = self._train_rows(j, j + train_block)
+                dists[i:i + test_block, j:j + rows.shape[0]] = np.sum(
+                    np.abs(X_block - rows[None, :, :]), axis=2)
+        return dists
+
+    def _encode(self, X):
+        """
+        Convert rows to the storage format, returning a tuple of the stored
+        rows and their int8 scales (None for the other storage modes).
+        """
+        if self.storage == 'float64':
+            return X, None
+        if self.storage == 'int8':
+            return _quantize_rows(X)
+        return X.astype(STORAGE_DTYPES[self.storage]), None
+
+    def _squared_norms(self, rows, scale):
+        """
+        Squared L2 norms of rows kept in the storage format, with their int8
+        scales if any; zeros for metrics that do not use them.
+        """
+        norms = np.zeros(rows.shape[0])
+        if self.metric != 'l2':
+            return norms
+        for j in xrange(0, rows.shape[0], TRAIN_BLOCK_SIZE):
+            block_scale = None if scale is None else scale[j:j + TRAIN_BLOCK_SIZE]
+            block = _decode_rows(rows[j:j + TRAIN_BLOCK_SIZE], block_scale)
+            norms[j:j + TRAIN_BLOCK_SIZE] = np.sum(np.square(block.astype(np.float64)), axis=1)
+        return norms
+
+    def _train_rows(self, start, end):
+        """
+        Return training rows [start, end) decoded from the storage format; for
+        compact modes the result is float32.
+        """
+        scale = None if self.train_scale is None else self.train_scale[start:end]
+        return _decode_rows(self.X_train[start:end], scale)
+
+    def _shared_train_path(self):
+        """
+        Return the path of a .npy file holding X_train: the mapped file if the
+        classifier was loaded with mmap=True, otherwise a copy written to a
+        parallel.shared_tmpdir the first time it is needed after train(),
+        add() or load().
+        """
+        if self._train_file is not None:
+            return self._train_file
+        if getattr(self, '_shared_dir', None) is None:
+            shared_dir = shared_tmpdir(prefix='knn_')
+            atexit.register(shutil.rmtree, shared_dir, True)
+            np.save(os.path.join(shared_dir, 'X_train.npy'), self.X_train)
+            self._shared_dir = shared_dir
+        return os.path.join(self._shared_dir, 'X_train.npy')
+
+    def _drop_shared_train(self):
+        """ Remove the shared copy of X_train, if one was written. """
+        if getattr(self, '_shared_dir', None) is not None:
+            shutil.rmtree(self._shared_dir, ignore_errors=True)
+        self._shared_dir = None
+
+
+def cross_validate_k(X, y, k_choices, num_folds=5):
+    """
+    Run k-fold cross-validation of a kNN classifier over several values of k.
+
+    Every fold's distance matrix is computed once and partitioned to the
+    max(k_choices) nearest neighbors; all candidate values of k are then scored
+    from prefixes of that one sorted neighbor-label table, so the sweep costs
+    about as much as a single predict per fold.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) containing the training data.
+    - y: A numpy array of shape (N,) containing the training labels.
+    - k_choices: A list of values of k to evaluate.
+    - num_folds: Number of folds to split the data into, as np.array_split
+      does.
+
+    Returns:
+    A dictionary mapping every k in k_choices to a list of num_folds validation
+    accuracies, one per fold.
+    """
+    X_folds = np.array_split(X, num_folds)
+    y_folds = np.array_split(y, num_folds)
+    k_to_accuracies = dict((k, []) for k in k_choices)
+
+    for fold in xrange(num_folds):
+        X_train = np.concatenate([X_folds[i] for i in xrange(num_folds) if i != fold])
+        y_train = np.concatenate([y_folds[i] for i in xrange(num_folds) if i != fold])
+        X_val, y_val = X_folds[fold], y_folds[fold]
+
+        dists = np.sum(np.square(X_val), axis=1, keepdims=True) - 2 * np.dot(X_val, X_train.T)
+        dists += np.sum(np.square(X_train), axis=1)
+        max_k = min(max(k_choices), X_train.shape[0])
+        nearest = np.argpartition(dists, max_k - 1, axis=1)[:, :max_k]
+        rows = np.arange(X_val.shape[0])[:, None]
+        nearest = nearest[rows, np.argsort(dists[rows, nearest], axis=1)]
+        closest_y = y_train[nearest]
+
+        for k in k_choices:
+            y_pred = _vote(closest_y[:, :k])
+            k_to_accuracies[k].append(np.mean(y_pred == y_val))
+
+    return k_to_accuracies
+
+
+def compare_storage_modes(X_train, y_train, X_test, y_test, k=1,
+                          storages=('float64', 'float32', 'float16', 'int8'),
+                          verbose=True):
+    """
+    Train one KNearestNeighbor per storage mode and report memory, distance
+    time and accuracy relative to float64.
+
+    Inputs:
+    - X_train, y_train: Training data and labels.
+    - X_test, y_test: Test data and labels used to measure accuracy.
+    - k: The number of nearest neighbors that vote for the predicted labels.
+    - storages: Storage modes to compare; the first one is the baseline.
+    - verbose: If true, print one line per storage mode.
+
+    Returns:
+    A list of dictionaries with keys 'storage', 'bytes', 'seconds',
+    'accuracy' and 'accuracy_delta'.
+    """
+    results = []
+    for storage in storages:
+        classifier = KNearestNeighbor()
+        classifier.train(X_train, y_train, storage=storage)
+        num_bytes = classifier.X_train.nbytes
+        if classifier.train_scale is not None:
+            num_bytes += classifier.train_scale.nbytes
+        tic = time.time()
+        dists = classifier.compute_distances_no_loops(X_test)
+        seconds = time.time() - tic
+        accuracy = np.mean(classifier.predict_labels(dists, k=k) == y_test)
+        results.append({'storage': storage, 'bytes': num_bytes,
+                        'seconds': seconds, 'accuracy': accuracy})
+
+    for r in results:
+        r['accuracy_delta'] = r['accuracy'] - results[0]['accuracy']
+        if verbose:
+            print('%-8s %8.1f MB  %.3f s  accuracy %.4f (%+.4f)' % (
+                  r['storage'], r['bytes'] / 1e6, r['seconds'], r['accuracy'],
+                  r['accuracy_delta']))
+    return results
+
+
+def _normalize_rows(X):
+    """ Scale every row of X to unit L2 norm, leaving all-zero rows as they are. """
+    norms = np.sqrt(np.sum(np.square(X), axis=1, keepdims=True))
+    norms[norms == 0] = 1.0
+    return X / norms
+
+
+def _decode_rows(rows, scale):
+    """
+    Decode stored rows back to floats: float64 rows are returned as they are,
+    compact ones as float32, multiplied by their int8 scales if given.
+    """
+    if rows.dtype == np.float64:
+        return rows
+    rows = rows.astype(np.float32, copy=False)
+    if scale is not None:
+        rows *= scale[:, None]
+    return rows
+
+
+def _quantize_rows(X):
+    """
+    Quantize every row of X to int8 with its own scale so that
+    X[i] ~= codes[i] * scale[i].
+    """
+    codes = np.zeros(X.shape, dtype=np.int8)
+    scale = np.zeros(X.shape[0], dtype=np.float32)
+    for j in xrange(0, X.shape[0], TRAIN_BLOCK_SIZE):
+        rows = X[j:j + TRAIN_BLOCK_SIZE]
+        row_scale = np.max(np.abs(rows), axis=1) / 127.0
+        row_scale[row_scale == 0] = 1.0
+        codes[j:j + TRAIN_BLOCK_SIZE] = np.round(rows / row_scale[:, None])
+        scale[j:j + TRAIN_BLOCK_SIZE] = row_scale
+    return codes, scale
+
+
+def _read_meta(path):
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+        return json.load(f)
+
+
+def _write_meta(path, meta):
+    tmp_path = os.path.join(path, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f)
+    os.rename(tmp_path, os.path.join(path, 'meta.json'))
+
+
+def _write_array(path, name, arr, meta):
+    """
+    Save arr to path/name.<generation>.npy and record the file name in meta.
+    """
+    filename = '%s.%d.npy' % (name, meta['generation'])
+    # recorded first, so that a partly written file is still cleaned up
+    meta['arrays'][name] = filename
+    np.save(os.path.join(path, filename), arr)
+
+
+def _append_array(path, name, arr, meta, old_meta):
+    """
+    Write the rows of the array named in old_meta followed by the rows of arr
+    to path/name.<generation>.npy, copying TRAIN_BLOCK_SIZE rows at a time,
+    and record the new file name in meta.
+    """
+    old = _open_array(path, name, old_meta, mmap=True)
+    filename = '%s.%d.npy' % (name, meta['generation'])
+    meta['arrays'][name] = filename
+    out = np.lib.format.open_memmap(os.path.join(path, filename), mode='w+',
+                                    dtype=old.dtype,
+                                    shape=(old.shape[0] + arr.shape[0],) + old.shape[1:])
+    num_old = old.shape[0]
+    for j in xrange(0, num_old, TRAIN_BLOCK_SIZE):
+        out[j:min(j + TRAIN_BLOCK_SIZE, num_old)] = old[j:j + TRAIN_BLOCK_SIZE]
+    out[num_old:] = arr
+    out.flush()
+    del out
+
+
+def _open_array(path, name, meta, mmap):
+    return np.load(os.path.join(path, meta['arrays'][name]),
+                   mmap_mode='r' if mmap else None)
+
+
+def _remove_arrays(path, meta, keep=None):
+    """ Remove the files of the arrays in meta that keep does not name too. """
+    kept = set(keep['arrays'].values()) if keep is not None else set()
+    for filename in meta['arrays'].values():
+        if filename not in kept:
+            _remove_file(os.path.join(path, filename))
+
+
+def _shard_top_k(args):
+    """
+    Worker for predict_parallel: top-k over training rows [start, end) of the
+    memory-mapped training set, with indices relative to the full set.
+    train_sq holds the cached squared norms of those rows.
+    """
+    path, start, end, train_sq, X, k, block_size = args
+    X_train = np.load(path, mmap_mode='r')
+    dists, idxs = _top_k_blocked(X, X_train[start:end], train_sq, k, block_size)
+    return dists, idxs + start
+
+
+def _remove_file(path):
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def _top_k_blocked(X, X_train, train_sq, k, block_size):
+    """
+    Find the k nearest rows of X_train for every row of X, processing both in
+    tiles of block_size rows and keeping only a running top-k per test point.
+    train_sq holds the squared norms of the rows of X_train, so that they are
+    sliced per tile rather than recomputed for every block of test rows.
+
+    Returns a tuple of:
+    - dists: A numpy array of shape (num_test, k) of squared L2 distances
+      (they rank the same as distances, so the sqrt is skipped)
+    - idxs: A numpy array of shape (num_test, k) of indices into X_train
+    """
+    num_test = X.shape[0]
+    num_train = X_train.shape[0]
+    k = min(k, num_train)
+    best_dists = np.zeros((num_test, k))
+    best_idxs = np.zeros((num_test, k), dtype=np.int64)
+    for i in xrange(0, num_test, block_size):
+        X_block = X[i:i + block_size]
+        test_sq = np.sum(np.square(X_block), axis=1, keepdims=True)
+        dists = np.zeros((X_block.shape[0], 0))
+        idxs = np.zeros((X_block.shape[0], 0), dtype=np.int64)
+        for j in xrange(0, num_train, block_size):
+            train_block = X_train[j:j + block_size]
+            block_dists = test_sq - 2 * np.dot(X_block, train_block.T)
+            block_dists += train_sq[j:j + block_size]
+            block_idxs = np.broadcast_to(np.arange(j, j + train_block.shape[0]),
+                                         block_dists.shape)
+            dists, idxs = _merge_top_k(dists, idxs, block_dists, block_idxs, k)
+        best_dists[i:i + block_size] = dists
+        best_idxs[i:i + block_size] = idxs
+    return best_dists, best_idxs
+
+
+def _merge_top_k(dists_a, idxs_a, dists_b, idxs_b, k):
+    """
+    Merge two sets of (distance, index) candidates row by row and keep the k
+    with the smallest distances. Candidates in the first set win ties, so
+    merging training blocks in order prefers lower training indices.
+    """
+    dists = np.hstack((dists_a, dists_b))
+    idxs = np.hstack((idxs_a, idxs_b))
+    if dists.shape[1] > k:
+        order = np.argsort(dists, axis=1, kind='mergesort')[:, :k]
+        rows = np.arange(dists.shape[0])[:, None]
+        dists, idxs = dists[rows, order], idxs[rows, order]
+    return dists, idxs
+
+
+def _vote(closest_y, weights=None):
+    """
+    Majority vote over each row of closest_y, a (num_test, k) array of
+    non-negative integer labels. Ties go to the smaller label, as in
+    predict_labels. If weights, an array of the same shape, is given, each
+    label counts with its weight; a weight of 0 leaves it out of the vote.
+    """
+    num_test, k = closest_y.shape
+    num_classes = np.max(closest_y) + 1 if closest_y.size else 1
+    offsets = num_classes * np.arange(num_test)[:, None]
+    counts = np.bincount((closest_y + offsets).ravel(),
+                         weights=None if weights is None else weights.ravel(),
+                         minlength=num_test * num_classes)
+    return np.argmax(counts.reshape(num_test, num_classes), axis=1)
@@ -1,6 +1,9 @@
 from __future__ import print_function
 
+import time
+
 import numpy as np
+from scipy.optimize import minimize
 from cs231n.classifiers.linear_svm import *
 from cs231n.classifiers.softmax import *
 from past.builtins import xrange
@@ -12,9 +15,10 @@ class LinearClassifier(object):
     self.W = None
 
   def train(self, X, y, learning_rate=1e-3, reg=1e-5, num_iters=100,
-            batch_size=200, verbose=False):
+            batch_size=200, verbose=False, solver='sgd', block_size=10000):
     """
-    Train this linear classifier using stochastic gradient descent.
+    Train this linear classifier using stochastic gradient descent, or with
+    full-batch L-BFGS.
 
     Inputs:
     - X: A numpy array of shape (N, D) containing training data; there are N
@@ -26,9 +30,17 @@ class LinearClassifier(object):
     - num_iters: (integer) number of steps to take when optimizing
     - batch_size: (integer) number of training examples to use at each step.
     - verbose: (boolean) If true, print progress during optimization.
+    - solver: (string) 'sgd' for minibatch stochastic gradient descent, or
+      'lbfgs' for L-BFGS on the full training set, which ignores
+      learning_rate and batch_size and uses num_iters as the maximum number
+      of L-BFGS iterations.
+    - block_size: (integer) number of examples per block when the lbfgs solver
+      evaluates the full-batch loss.
 
     Outputs:
     A list containing the value of the loss function at each training iteration.
+    The cumulative wall-clock time in seconds at the end of each iteration is
+    stored in self.time_history.
     """
     num_train, dim = X.shape
     num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
@@ -36,8 +48,15 @@ class LinearClassifier(object):
       # lazily initialize W
       self.W = 0.001 * np.random.randn(dim, num_classes)
 
+    if solver == 'lbfgs':
+      return self._train_lbfgs(X, y, reg, num_iters, block_size, verbose)
+    elif solver != 'sgd':
+      raise ValueError('Invalid solver "%s"' % solver)
+
     # Run stochastic gradient descent to optimize W
     loss_history = []
+    self.time_history = []
+    start_time = time.time()
     for it in xrange(num_iters):
       X_batch = None
       y_batch = None
@@ -76,12 +95,158 @@ class LinearClassifier(object):
       #########################################################################
       #                       END OF YOUR CODE                                #
       #########################################################################
+      self.time_history.append(time.time() - start_time)
 
       if verbose and it % 100 == 0:
         print('iteration %d / %d: loss %f' % (it, num_iters, loss))
 
     return loss_history
 
+  def _train_lbfgs(self, X, y, reg, num_iters, block_size, verbose):
+    """
+    Minimize the full-batch loss from smooth_loss with L-BFGS, starting from
+    self.W. The loss and gradient over the whole training set are evaluated
+    block by block, so no (N, C) array for all of X is built at once.
+    """
+    num_train = X.shape[0]
+    shape = self.W.shape
+    loss_history = []
+    self.time_history = []
+    evaluated = {}
+
+    def full_batch_loss(w):
+      W = w.reshape(shape)
+      loss, dW = 0.0, np.zeros(shape)
+      for start in xrange(0, num_train, block_size):
+        X_block, y_block = X[start:start + block_size], y[start:start + block_size]
+        # weighting the regularized block losses by block size adds up to the
+        # data loss over all of X plus the regularization loss counted once
+        weight = float(X_block.shape[0]) / num_train
+        block_loss, block_grad = self.smooth_loss(W, X_block, y_block, reg)
+        loss += weight * block_loss
+        dW += weight * block_grad
+      evaluated['loss'] = loss
+      evaluated['passes'] = evaluated.get('passes', 0) + 1
+      return loss, dW.ravel()
+
+    def callback(w):
+      loss_history.append(evaluated['loss'])
+      self.time_history.append(time.time() - start_time)
+      if verbose:
+        print('iteration %d / %d: loss %f (%d data passes, %.2fs)' % (
+              len(loss_history), num_iters, evaluated['loss'],
+              evaluated['passes'], self.time_history[-1]))
+
+    start_time = time.time()
+    result = minimize(full_batch_loss, self.W.ravel(), jac=True,
+                      method='L-BFGS-B', callback=callback,
+                      options={'maxiter': num_iters})
+    self.W = result.x.reshape(shape)
+    return loss_history
+
+  def partial_fit(self, X_batch, y_batch, learning_rate=1e-3, reg=1e-5,
+                  num_classes=None):
+    """
+    Take a single stochastic gradient descent step on one minibatch.
+
+    Inputs:
+    - X_batch: A numpy array of shape (N, D) containing a minibatch.
+    - y_batch: A numpy array of shape (N,) containing labels for the minibatch.
+    - learning_rate: (float) learning rate for optimization.
+    - reg: (float) regularization strength.
+    - num_classes: (integer) number of classes, used to initialize W on the
+      first call; if None it is inferred from y_batch, which then has to
+      contain the largest label.
+
+    Returns:
+    The loss on the minibatch before the update.
+    """
+    if self.W is None:
+      if num_classes is None:
+        num_classes = np.max(y_batch) + 1
+      self.W = 0.001 * np.random.randn(X_batch.shape[1], num_classes)
+    loss, grad = self.loss(X_batch, y_batch, reg)
+    self.W -= learning_rate * grad
+    return loss
+
+  def train_streaming(self, chunks, learning_rate=1e-3, reg=1e-5,
+                      batch_size=None, num_classes=None, verbose=False):
+    """
+    Train with stochastic gradient descent on data that does not fit in
+    memory, consuming it one chunk at a time.
+
+    Inputs:
+    - chunks: An iterable of (X_chunk, y_chunk) pairs, for example a generator
+      reading from disk or iterate_contiguous_batches over a memory-mapped
+      array.
+    - learning_rate: (float) learning rate for optimization.
+    - reg: (float) regularization strength.
+    - batch_size: (integer) if given, every chunk is split into minibatches of
+      this many rows (as views, without copying); otherwise every chunk is
+      one minibatch.
+    - num_classes: (integer) number of classes; see partial_fit.
+    - verbose: (boolean) If true, print progress during optimization.
+
+    Outputs:
+    A list containing the value of the loss function at each training iteration.
+    """
+    loss_history = []
+    for X_chunk, y_chunk in chunks:
+      step = batch_size or X_chunk.shape[0]
+      for start in xrange(0, X_chunk.shape[0], step):
+        loss = self.partial_fit(X_chunk[start:start + step], y_chunk[start:start + step],
+                                learning_rate, reg, num_classes)
+        loss_history.append(loss)
+        if verbose and len(loss_history) % 100 == 1:
+          print('iteration %d: loss %f' % (len(loss_history) - 1, loss))
+
+    return loss_history
+
+  def train_grid(self, X, y, hyperparams, num_iters=100, batch_size=200,
+                 verbose=False):
+    """
+    Train one model per (learning_rate, reg) pair with stochastic gradient
+    descent, all at once: the G weight matrices are stacked into a (G, D, C)
+    tensor and every sampled minibatch is shared by all of them, so each step
+    is one larger GEMM through loss_batched instead of G small ones.
+
+    Inputs:
+    - X: A numpy array of shape (N, D) containing training data.
+    - y: A numpy array of shape (N,) containing training labels.
+    - hyperparams: A list of G (learning_rate, reg) tuples.
+    - num_iters: (integer) number of steps to take when optimizing
+    - batch_size: (integer) number of training examples to use at each step.
+    - verbose: (boolean) If true, print progress during optimization.
+
+    Returns a tuple of:
+    - classifiers: A list of G trained classifiers of the same class as this
+      one; classifiers[g] was trained with hyperparams[g].
+    - loss_history: A numpy array of shape (num_iters, G) giving the loss of
+      every model at each iteration.
+    """
+    num_train, dim = X.shape
+    num_classes = np.max(y) + 1 # assume y takes values 0...K-1 where K is number of classes
+    learning_rates = np.array([lr for lr, _ in hyperparams])
+    regs = np.array([reg for _, reg in hyperparams])
+    W = 0.001 * np.random.randn(len(hyperparams), dim, num_classes)
+
+    loss_history = []
+    for it in xrange(num_iters):
+      indices = np.random.choice(num_train, size=batch_size)
+      loss, grad = self.loss_batched(W, X[indices], y[indices], regs)
+      loss_history.append(loss)
+      W -= learning_rates[:, None, None] * grad
+
+      if verbose and it % 100 == 0:
+        print('iteration %d / %d: loss min %f max %f' % (it, num_iters, np.min(loss), np.max(loss)))
+
+    classifiers = []
+    for g in xrange(len(hyperparams)):
+      classifier = self.__class__()
+      classifier.W = W[g].copy()
+      classifiers.append(classifier)
+    return classifiers, np.array(loss_history)
+
   def predict(self, X):
     """
     Use the trained weights of this linear classifier to predict labels for
@@ -128,6 +293,136 @@ class LinearClassifier(object):
     """
     pass
 
+  def smooth_loss(self, W, X_batch, y_batch, reg):
+    """
+    Compute a smooth loss function and its derivative at the weights W, for
+    the lbfgs solver. Subclasses will override this.
+
+    Inputs and outputs are the same as loss, except that the weights are
+    passed in as W instead of read from self.W.
+    """
+    pass
+
+  def loss_batched(self, W, X_batch, y_batch, reg):
+    """
+    Compute the loss function and its derivative for a stack of weight
+    matrices. Subclasses will override this.
+
+    Inputs:
+    - W: A numpy array of shape (G, D, C) containing G weight matrices.
+    - X_batch: A numpy array of shape (N, D) containing a minibatch.
+    - y_batch: A numpy array of shape (N,) containing labels for the minibatch.
+    - reg: A numpy array of shape (G,) of regularization strengths.
+
+    Returns: A tuple containing:
+    - losses as a numpy array of shape (G,)
+    - gradient with respect to W; an array of shape (G, D, C)
+    """
+    pass
+
+
+def iterate_contiguous_batches(X, y, batch_size=200, num_batches=None,
+                               dtype=None):
+  """
+  Yield minibatches of contiguous rows of X and y, visiting the blocks in a
+  new random order on every pass. Contiguous blocks turn reads from a
+  memory-mapped X into sequential I/O, unlike np.random.choice fancy indexing,
+  so the rows of X should be shuffled once when the file is written.
+
+  The same preallocated buffers are filled and yielded for every batch, so a
+  consumer must use each batch before asking for the next one.
+
+  Inputs:
+  - X: A numpy array or np.memmap of shape (N, D).
+  - y: A numpy array of shape (N,) of labels.
+  - batch_size: (integer) rows per batch; a trailing partial block is skipped.
+  - num_batches: (integer) number of batches to yield; if None, cycle
+    forever.
+  - dtype: dtype of the yielded X batches; defaults to X.dtype.
+
+  Raises ValueError if X holds fewer than batch_size rows, since there would
+  be no full block to yield.
+  """
+  if X.shape[0] < batch_size:
+    raise ValueError('Need at least batch_size=%d rows, got %d'
+                     % (batch_size, X.shape[0]))
+  return _contiguous_batches(X, y, batch_size, num_batches, dtype)
+
+
+def _contiguous_batches(X, y, batch_size, num_batches, dtype):
+  num_blocks = X.shape[0] // batch_size
+  X_batch = np.empty((batch_size,) + X.shape[1:], dtype=dtype or X.dtype)
+  y_batch = np.empty(batch_size, dtype=y.dtype)
+  count = 0
+  while num_batches is None or count < num_batches:
+    for block in np.random.permutation(num_blocks):
+      if num_batches is not None and count >= num_batches:
+        break
+      X_batch[...] = X[block * batch_size:(block + 1) * batch_size]
+      y_batch[...] = y[block * batch_size:(block + 1) * batch_size]
+      yield X_batch, y_batch
+      count += 1
+
+
+def compare_loss_kernels(W, X, y, reg, dtypes=(np.float64, np.float32),
+                         num_iters=10, verbose=True):
+  """
+  Time the vectorized and the fused SVM and softmax losses on the same data
+  and check that they agree.
+
+  The fused kernels are called with a scores workspace and a gradient array
+  allocated once and reused across iterations, the way a training loop would
+  call them.
+
+  Inputs:
+  - W: A numpy array of shape (D, C) containing weights.
+  - X: A numpy array of shape (N, D) containing a minibatch of data.
+  - y: A numpy array of shape (N,) containing training labels.
+  - reg: (float) regularization strength.
+  - dtypes: dtypes to cast W and X to for the fused kernels; the vectorized
+    ones always run in float64 and serve as the reference.
+  - num_iters: Number of calls timed per kernel.
+  - verbose: If true, print one line per kernel and dtype.
+
+  Returns:
+  A list of dictionaries with keys 'loss' ('svm' or 'softmax'), 'kernel'
+  ('vectorized' or 'fused'), 'dtype', 'ms_per_call', 'loss_error' and
+  'grad_error', the last two being the max absolute differences from the
+  vectorized float64 loss and gradient.
+  """
+  kernels = [('svm', svm_loss_vectorized, svm_loss_fused),
+             ('softmax', softmax_loss_vectorized, softmax_loss_fused)]
+  W64, X64 = W.astype(np.float64), X.astype(np.float64)
+  results = []
+  for name, vectorized, fused in kernels:
+    tic = time.time()
+    for it in xrange(num_iters):
+      ref_loss, ref_grad = vectorized(W64, X64, y, reg)
+    results.append({'loss': name, 'kernel': 'vectorized', 'dtype': 'float64',
+                    'seconds': time.time() - tic, 'loss_error': 0.0,
+                    'grad_error': 0.0})
+
+    for dtype in dtypes:
+      W_cast, X_cast = W.astype(dtype), X.astype(dtype)
+      scores = np.empty((X.shape[0], W.shape[1]), dtype=dtype)
+      dW = np.empty(W.shape, dtype=dtype)
+      tic = time.time()
+      for it in xrange(num_iters):
+        loss, grad = fused(W_cast, X_cast, y, reg, scores=scores, dW=dW)
+      results.append({'loss': name, 'kernel': 'fused',
+                      'dtype': np.dtype(dtype).name,
+                      'seconds': time.time() - tic,
+                      'loss_error': abs(loss - ref_loss),
+                      'grad_error': np.max(np.abs(grad - ref_grad))})
+
+  for r in results:
+    r['ms_per_call'] = 1000.0 * r.pop('seconds') / num_iters
+    if verbose:
+      print('%-8s %-10s %-8s %8.3f ms/call  loss error %.2e  grad error %.2e' % (
+            r['loss'], r['kernel'], r['dtype'], r['ms_per_call'],
+            r['loss_error'], r['grad_error']))
+  return results
+
 
 class LinearSVM(LinearClassifier):
   """ A subclass that uses the Multiclass SVM loss function """
@@ -135,6 +430,12 @@ class LinearSVM(LinearClassifier):
   def loss(self, X_batch, y_batch, reg):
     return svm_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+  def loss_batched(self, W, X_batch, y_batch, reg):
+    return svm_loss_batched(W, X_batch, y_batch, reg)
+
+  def smooth_loss(self, W, X_batch, y_batch, reg):
+    return svm_loss_smoothed(W, X_batch, y_batch, reg)
+
 
 class Softmax(LinearClassifier):
   """ A subclass that uses the Softmax + Cross-entropy loss function """
@@ -142,3 +443,9 @@ class Softmax(LinearClassifier):
   def loss(self, X_batch, y_batch, reg):
     return softmax_loss_vectorized(self.W, X_batch, y_batch, reg)
 
+  def loss_batched(self, W, X_batch, y_batch, reg):
+    return softmax_loss_batched(W, X_batch, y_batch, reg)
+
+  def smooth_loss(self, W, X_batch, y_batch, reg):
+    return softmax_loss_vectorized(W, X_batch, y_batch, reg)
+
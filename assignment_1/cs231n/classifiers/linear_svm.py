@@ -130,3 +130,122 @@ def svm_loss_vectorized(W, X, y, reg):
   #############################################################################
 
   return loss, dW
+
+
+def svm_loss_fused(W, X, y, reg, scores=None, dW=None):
+  """
+  Structured SVM loss function, fused single-pass version. The scores,
+  margins and their gradient all live in one (N, C) workspace that is
+  updated in place, and the dtype of X and W is kept (float32 stays float32;
+  mixed inputs are computed in np.result_type(X, W)).
+
+  Inputs are the same as svm_loss_naive, plus:
+  - scores: Optional C-contiguous workspace of shape (N, C) with the dtype
+    np.result_type(X, W); it is overwritten. If None, a new array is
+    allocated.
+  - dW: Optional C-contiguous array of shape (D, C) with the dtype
+    np.result_type(X, W) into which the gradient is written. If None, a new
+    array is allocated.
+
+  Returns a tuple of:
+  - loss as single float
+  - gradient with respect to weights W; dW if it was given
+  """
+  N = X.shape[0]
+  rows = np.arange(N)
+  dtype = np.result_type(X, W)
+  if scores is None:
+    scores = np.empty((N, W.shape[1]), dtype=dtype)
+  if dW is None:
+    dW = np.empty(W.shape, dtype=dtype)
+
+  np.dot(X, W, out=scores)
+  scores -= scores[rows, y][:, np.newaxis]
+  scores += 1
+  scores[rows, y] = 0
+  np.maximum(scores, 0, out=scores) # margins
+  loss = np.sum(scores) / N + 0.5 * reg * np.vdot(W, W)
+
+  # margins are non-negative, so their sign is the indicator margin > 0
+  np.sign(scores, out=scores)
+  scores[rows, y] -= np.sum(scores, axis=1)
+  scores /= N
+  np.dot(X.T, scores, out=dW)
+  dW += reg * W
+
+  return loss, dW
+
+
+def svm_loss_smoothed(W, X, y, reg, smoothing=1.0):
+  """
+  Structured SVM loss with the hinge replaced by a smoothed hinge, so that
+  the loss is differentiable everywhere and can be minimized with
+  quasi-Newton methods. A margin m contributes 0 for m <= 0,
+  m^2 / (2 * smoothing) for 0 < m < smoothing, and m - smoothing / 2 beyond;
+  as smoothing goes to 0 this becomes svm_loss_vectorized.
+
+  Inputs are the same as svm_loss_naive, plus:
+  - smoothing: (float) width of the quadratic part of the hinge.
+
+  Returns a tuple of:
+  - loss as single float
+  - gradient with respect to weights W; an array of same shape as W
+  """
+  N = X.shape[0]
+  rows = np.arange(N)
+
+  scores = X.dot(W) # shape = (N, C)
+  margins = scores - scores[rows, y].reshape(N, 1) + 1
+  margins[rows, y] = 0
+
+  quadratic = (margins > 0) & (margins < smoothing)
+  linear = margins >= smoothing
+  loss = (np.sum(np.square(margins[quadratic])) / (2 * smoothing)
+          + np.sum(margins[linear] - smoothing / 2.0)) / N
+  loss += 0.5 * reg * np.sum(W * W)
+
+  d_scores = np.where(linear, 1.0, np.where(quadratic, margins / smoothing, 0.0))
+  d_scores[rows, y] -= np.sum(d_scores, axis=1)
+  dW = X.T.dot(d_scores) / N
+  dW += reg * W
+
+  return loss, dW
+
+
+def svm_loss_batched(W, X, y, reg):
+  """
+  Structured SVM loss function for G weight matrices at once, sharing one
+  minibatch. The scores of all G models come from a single GEMM of X against
+  the stacked weights instead of G small ones.
+
+  Inputs:
+  - W: A numpy array of shape (G, D, C) containing G weight matrices.
+  - X: A numpy array of shape (N, D) containing a minibatch of data.
+  - y: A numpy array of shape (N,) containing training labels.
+  - reg: (float or array of shape (G,)) regularization strength per model.
+
+  Returns a tuple of:
+  - loss: A numpy array of shape (G,); loss[g] equals the loss that
+    svm_loss_vectorized gives for W[g]
+  - gradient with respect to W; an array of shape (G, D, C)
+  """
+  G, D, C = W.shape
+  N = X.shape[0]
+  reg = np.broadcast_to(np.asarray(reg, dtype=W.dtype), (G,))
+  rows = np.arange(N)
+
+  scores = X.dot(W.transpose(1, 0, 2).reshape(D, G * C)).reshape(N, G, C)
+  correct_class_scores = scores[rows, :, y] # shape = (N, G)
+  margins = np.maximum(scores - correct_class_scores[:, :, None] + 1, 0)
+  margins[rows, :, y] = 0
+
+  loss = np.sum(margins, axis=(0, 2)) / N
+  loss += 0.5 * reg * np.einsum('gdc,gdc->g', W, W)
+
+  d_scores = (margins > 0).astype(W.dtype) # shape = (N, G, C)
+  d_scores[rows, :, y] -= np.sum(d_scores, axis=2)
+  d_scores /= N
+  dW = reg[:, None, None] * W
+  dW += X.T.dot(d_scores.reshape(N, G * C)).reshape(D, G, C).transpose(1, 0, 2)
+
+  return loss, dW
@@ -114,3 +114,74 @@ def softmax_loss_vectorized(W, X, y, reg):
 
   return loss, dW
 
+
+def softmax_loss_fused(W, X, y, reg, scores=None, dW=None):
+  """
+  Softmax loss function, fused single-pass version. The scores, their
+  exponentials and the probabilities all live in one (N, C) workspace that
+  is updated in place, and the dtype of X and W is kept (float32 stays
+  float32).
+
+  Inputs and outputs are the same as svm_loss_fused.
+  """
+  N = X.shape[0]
+  rows = np.arange(N)
+  dtype = np.result_type(X, W)
+  if scores is None:
+    scores = np.empty((N, W.shape[1]), dtype=dtype)
+  if dW is None:
+    dW = np.empty(W.shape, dtype=dtype)
+
+  np.dot(X, W, out=scores)
+  scores -= np.max(scores, axis=1, keepdims=True)
+  correct_scores = scores[rows, y]
+  np.exp(scores, out=scores)
+  sum_exp_scores = np.sum(scores, axis=1)
+  loss = -np.sum(correct_scores - np.log(sum_exp_scores)) / N
+  loss += reg * np.vdot(W, W)
+
+  scores /= sum_exp_scores[:, np.newaxis] # softmax probabilities
+  scores[rows, y] -= 1
+  scores /= N
+  np.dot(X.T, scores, out=dW)
+  dW += 2 * reg * W
+
+  return loss, dW
+
+
+def softmax_loss_batched(W, X, y, reg):
+  """
+  Softmax loss function for G weight matrices at once, sharing one minibatch.
+  The scores of all G models come from a single GEMM of X against the stacked
+  weights instead of G small ones.
+
+  Inputs:
+  - W: A numpy array of shape (G, D, C) containing G weight matrices.
+  - X: A numpy array of shape (N, D) containing a minibatch of data.
+  - y: A numpy array of shape (N,) containing training labels.
+  - reg: (float or array of shape (G,)) regularization strength per model.
+
+  Returns a tuple of:
+  - loss: A numpy array of shape (G,); loss[g] equals the loss that
+    softmax_loss_vectorized gives for W[g]
+  - gradient with respect to W; an array of shape (G, D, C)
+  """
+  G, D, C = W.shape
+  N = X.shape[0]
+  reg = np.broadcast_to(np.asarray(reg, dtype=W.dtype), (G,))
+  rows = np.arange(N)
+
+  scores = X.dot(W.transpose(1, 0, 2).reshape(D, G * C)).reshape(N, G, C)
+  scores -= np.max(scores, axis=2, keepdims=True)
+  exp_scores = np.exp(scores)
+  softmax_probability = exp_scores / np.sum(exp_scores, axis=2, keepdims=True)
+
+  loss = np.sum(-np.log(softmax_probability[rows, :, y]), axis=0) / N
+  loss += reg * np.einsum('gdc,gdc->g', W, W)
+
+  softmax_probability[rows, :, y] -= 1
+  softmax_probability /= N
+  dW = 2 * reg[:, None, None] * W
+  dW += X.T.dot(softmax_probability.reshape(N, G * C)).reshape(D, G, C).transpose(1, 0, 2)
+
+  return loss, dW
@@ -1,24 +1,44 @@
 from __future__ import print_function
 from past.builtins import xrange
 
+import functools
+import hashlib
+import os
+
 import matplotlib
 import numpy as np
 from scipy.ndimage import uniform_filter
 
+from cs231n.parallel import shared_npy, spawn_pool
+
 
-def extract_features(imgs, feature_fns, verbose=False):
+def extract_features(imgs, feature_fns, verbose=False, dtype=np.float64,
+                     num_workers=None, chunk_size=1000, out_path=None):
   """
   Given pixel data for images and several feature functions that can operate on
   single images, apply all feature functions to all images, concatenating the
   feature vectors for each image and storing the features for all images in
   a single matrix.
 
+  With num_workers set, the images are split into chunks of chunk_size that a
+  pool of worker processes handles in parallel. The images reach the workers
+  through parallel.shared_npy, and every worker writes the features of its
+  chunk straight into a memory-mapped output file, so neither the images nor
+  the features are pickled between processes. Every row is computed by the same calls as in
+  the serial loop, so the result is bit-identical for any num_workers.
+
   Inputs:
   - imgs: N x H X W X C array of pixel data for N images.
   - feature_fns: List of k feature functions. The ith feature function should
     take as input an H x W x D array and return a (one-dimensional) array of
-    length F_i.
+    length F_i. With num_workers set they must be picklable, e.g. functions
+    defined at module level or functools.partial objects of them.
   - verbose: Boolean; if true, print progress.
+  - dtype: dtype of the returned features, e.g. np.float32 to halve memory.
+  - num_workers: If not None, number of worker processes to use.
+  - chunk_size: Number of images per task when num_workers is set.
+  - out_path: If not None, the features are written to this .npy file and
+    returned memory-mapped from it instead of held in memory.
 
   Returns:
   An array of shape (N, F_1 + ... + F_k) where each column is the concatenation
@@ -40,22 +60,165 @@ def extract_features(imgs, feature_fns, verbose=False):
   # Now that we know the dimensions of the features, we can allocate a single
   # big array to store all features as columns.
   total_feature_dim = sum(feature_dims)
-  imgs_features = np.zeros((num_images, total_feature_dim))
+  if num_workers is not None:
+    return _extract_features_parallel(imgs, feature_fns, feature_dims, verbose,
+                                      dtype, num_workers, chunk_size, out_path)
+  if out_path is not None:
+    imgs_features = np.lib.format.open_memmap(
+        out_path, mode='w+', dtype=dtype, shape=(num_images, total_feature_dim))
+  else:
+    imgs_features = np.zeros((num_images, total_feature_dim), dtype=dtype)
   imgs_features[0] = np.hstack(first_image_features).T
 
   # Extract features for the rest of the images.
   for i in xrange(1, num_images):
-    idx = 0
-    for feature_fn, feature_dim in zip(feature_fns, feature_dims):
-      next_idx = idx + feature_dim
-      imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
-      idx = next_idx
+    _fill_features(imgs_features, imgs, i, feature_fns, feature_dims)
     if verbose and i % 1000 == 0:
       print('Done extracting features for %d / %d images' % (i, num_images))
 
+  if out_path is not None:
+    imgs_features.flush()
   return imgs_features
 
 
+def _fill_features(imgs_features, imgs, i, feature_fns, feature_dims):
+  """ Write the features of image i into row i of imgs_features. """
+  idx = 0
+  for feature_fn, feature_dim in zip(feature_fns, feature_dims):
+    next_idx = idx + feature_dim
+    imgs_features[i, idx:next_idx] = feature_fn(imgs[i].squeeze())
+    idx = next_idx
+
+
+def _extract_features_parallel(imgs, feature_fns, feature_dims, verbose, dtype,
+                               num_workers, chunk_size, out_path):
+  """ The num_workers path of extract_features. """
+  num_images = imgs.shape[0]
+  with shared_npy({'imgs': imgs}, prefix='extract_features_') as data_dir:
+    imgs_path = os.path.join(data_dir, 'imgs.npy')
+    features_path = out_path or os.path.join(data_dir, 'features.npy')
+    imgs_features = np.lib.format.open_memmap(
+        features_path, mode='w+', dtype=dtype,
+        shape=(num_images, sum(feature_dims)))
+    del imgs_features # the workers write through their own mappings
+
+    jobs = [(imgs_path, features_path, feature_fns, feature_dims, start,
+             min(start + chunk_size, num_images))
+            for start in xrange(0, num_images, chunk_size)]
+    pool = spawn_pool(num_workers)
+    try:
+      num_done = 0
+      for num_rows in pool.imap_unordered(_extract_chunk, jobs):
+        num_done += num_rows
+        if verbose:
+          print('Done extracting features for %d / %d images' % (num_done, num_images))
+    finally:
+      pool.terminate()
+      pool.join()
+
+    if out_path is not None:
+      return np.load(out_path, mmap_mode='r')
+    return np.load(features_path)
+
+
+def _extract_chunk(args):
+  """ Worker for extract_features: fill rows [start, end) of the output. """
+  imgs_path, features_path, feature_fns, feature_dims, start, end = args
+  imgs = np.load(imgs_path, mmap_mode='r')
+  imgs_features = np.load(features_path, mmap_mode='r+')
+  for i in xrange(start, end):
+    _fill_features(imgs_features, imgs, i, feature_fns, feature_dims)
+  imgs_features.flush()
+  return end - start
+
+
+def extract_features_cached(imgs, feature_fns, cache_dir, max_bytes=4 * 2 ** 30,
+                            verbose=False, dtype=np.float64, **kwargs):
+  """
+  extract_features with an on-disk cache. Results are stored in cache_dir
+  as .npy files named by a hash of the images (their bytes, shape and
+  dtype), of the identities of the feature functions and of dtype. A hit
+  is returned memory-mapped, without recomputing anything; the cost of a
+  warm start is hashing imgs.
+
+  A feature function is identified by its module, name and default
+  arguments, and a functools.partial also by the arguments it binds, so
+  partial(color_histogram_hsv, nbin=20) gets its own entry.
+
+  The cache is bounded to max_bytes: after every miss the least recently
+  used entries are removed until the rest fit.
+
+  Inputs:
+  - imgs, feature_fns, verbose, dtype: As in extract_features.
+  - cache_dir: Directory holding the cache; created if needed.
+  - max_bytes: Maximum total size of the cached files.
+  - kwargs: Other keyword arguments of extract_features, e.g. num_workers.
+
+  Returns:
+  The array extract_features would return, memory-mapped from the cache.
+  """
+  if imgs.shape[0] == 0:
+    return extract_features(imgs, feature_fns, verbose=verbose, dtype=dtype)
+  if not os.path.isdir(cache_dir):
+    os.makedirs(cache_dir)
+
+  key = hashlib.sha1()
+  key.update(repr((imgs.shape, imgs.dtype.str, np.dtype(dtype).str)).encode('utf-8'))
+  for feature_fn in feature_fns:
+    key.update(_function_key(feature_fn).encode('utf-8'))
+  flat = np.ascontiguousarray(imgs).reshape(imgs.shape[0], -1)
+  for i in xrange(0, flat.shape[0], 1000):
+    key.update(np.ascontiguousarray(flat[i:i + 1000]).data)
+  path = os.path.join(cache_dir, key.hexdigest() + '.npy')
+
+  if os.path.exists(path):
+    os.utime(path, None) # mark as recently used
+    if verbose:
+      print('Loaded cached features from %s' % path)
+    return np.load(path, mmap_mode='r')
+
+  tmp_path = path + '.tmp.npy'
+  try:
+    extract_features(imgs, feature_fns, verbose=verbose, dtype=dtype,
+                     out_path=tmp_path, **kwargs)
+    os.rename(tmp_path, path)
+  finally:
+    if os.path.exists(tmp_path):
+      os.remove(tmp_path)
+  _evict_features(cache_dir, max_bytes, keep=path)
+  return np.load(path, mmap_mode='r')
+
+
+def _function_key(fn):
+  """ A string identifying a feature function and the arguments it uses. """
+  if isinstance(fn, functools.partial):
+    return '%s(*%r, **%r)' % (_function_key(fn.func), fn.args,
+                               sorted((fn.keywords or {}).items()))
+  name = getattr(fn, '__qualname__', getattr(fn, '__name__', repr(fn)))
+  return '%s.%s%r' % (getattr(fn, '__module__', None), name,
+                      getattr(fn, '__defaults__', None))
+
+
+def _evict_features(cache_dir, max_bytes, keep):
+  """
+  Remove the least recently used .npy files of cache_dir, other than keep,
+  until the total size is at most max_bytes.
+  """
+  entries = []
+  for name in os.listdir(cache_dir):
+    path = os.path.join(cache_dir, name)
+    if name.endswith('.npy') and not name.endswith('.tmp.npy'):
+      stat = os.stat(path)
+      entries.append((stat.st_mtime, stat.st_size, path))
+  total = sum(size for _, size, _ in entries)
+  for _, size, path in sorted(entries):
+    if total <= max_bytes:
+      break
+    if path != keep:
+      os.remove(path)
+      total -= size
+
+
 def rgb2gray(rgb):
   """Convert RGB image to grayscale
 
@@ -123,6 +286,79 @@ def hog_feature(im):
   return orientation_histogram.ravel()
 
 
+def hog_feature_batched(imgs, chunk_size=128):
+  """Compute the HOG feature of every image in a stack at once
+
+    The same feature as hog_feature, computed with array operations over
+    chunks of chunk_size images: the gradients and orientation bins of all
+    pixels of a chunk are found together, and the cells are pooled with a
+    single np.bincount over (image, cell, orientation) keys instead of one
+    uniform_filter pass per orientation. The bins are decided by the same
+    comparisons as in hog_feature; only the order in which the magnitudes
+    of a cell are summed differs, so results match hog_feature to floating
+    point rounding.
+
+    Parameters:
+      imgs : N x H x W x C stack of rgb images, or N x H x W grayscale ones
+      chunk_size : number of images processed at a time
+
+    Returns:
+      feat: N x F array whose ith row is hog_feature(imgs[i])
+
+  """
+  num_images, sx, sy = imgs.shape[:3] # image size
+  orientations = 9 # number of gradient bins
+  cx, cy = (8, 8) # pixels per cell
+  n_cellsx = int(np.floor(sx / cx))  # number of cells in x
+  n_cellsy = int(np.floor(sy / cy))  # number of cells in y
+  num_cells = n_cellsx * n_cellsy
+
+  # cell of every pixel; pixels past the last whole cell go to an extra cell
+  cells = (np.arange(sx)[:, None] // cx) * n_cellsy + np.arange(sy) // cy
+  cells[n_cellsx * cx:] = num_cells
+  cells[:, n_cellsy * cy:] = num_cells
+  bin_width = 180 / orientations
+
+  feat = np.zeros((num_images, n_cellsx, n_cellsy, orientations))
+  for i in xrange(0, num_images, chunk_size):
+    chunk = imgs[i:i + chunk_size]
+    n = chunk.shape[0]
+    # convert rgb to grayscale if needed
+    image = rgb2gray(chunk) if chunk.ndim == 4 else chunk.astype(np.float64)
+
+    # the arithmetic of hog_feature, done in place to save temporaries
+    gx = np.zeros(image.shape)
+    gy = np.zeros(image.shape)
+    np.subtract(image[:, :, 1:], image[:, :, :-1], out=gx[:, :, :-1]) # gradient on x-direction
+    np.subtract(image[:, 1:, :], image[:, :-1, :], out=gy[:, :-1, :]) # gradient on y-direction
+    grad_mag = np.square(gx)
+    grad_mag += np.square(gy)
+    np.sqrt(grad_mag, out=grad_mag) # gradient magnitude
+    gx += 1e-15
+    grad_ori = np.arctan2(gy, gx, out=gx)
+    grad_ori *= 180 / np.pi
+    grad_ori += 90 # gradient orientation
+
+    # hog_feature puts a pixel in bin i if bin_width * i <= orientation <
+    # bin_width * (i + 1) and orientation > 0. Dividing can only round up
+    # onto a bin edge, never below one, so one correction step is exact.
+    bins = np.floor(grad_ori / bin_width)
+    bins -= grad_ori < bins * bin_width
+    # orientations outside (0, 180) go to an extra bin that is dropped
+    bins[(grad_ori <= 0) | (grad_ori >= 180)] = orientations
+
+    keys = ((np.arange(n)[:, None, None] * (num_cells + 1) + cells)
+            * (orientations + 1) + bins.astype(np.intp))
+    sums = np.bincount(keys.ravel(), weights=grad_mag.ravel(),
+                       minlength=n * (num_cells + 1) * (orientations + 1))
+    sums = sums.reshape(n, num_cells + 1, orientations + 1)[:, :num_cells, :orientations]
+    feat[i:i + n] = sums.reshape(n, n_cellsx, n_cellsy, orientations)
+  feat /= cx * cy
+
+  # hog_feature lays the cells out transposed
+  return feat.transpose(0, 2, 1, 3).reshape(num_images, -1)
+
+
 def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   """
   Compute color histogram for an image using hue.
@@ -148,4 +384,75 @@ def color_histogram_hsv(im, nbin=10, xmin=0, xmax=255, normalized=True):
   return imhist
 
 
+def color_histogram_hsv_batched(imgs, nbin=10, xmin=0, xmax=255, normalized=True,
+                                chunk_size=256):
+  """
+  Compute the hue histogram of every image in a stack at once.
+
+  The hue of a chunk of images is computed at once with the arithmetic of
+  matplotlib.colors.rgb_to_hsv, skipping saturation and value, and each
+  chunk is binned with one np.bincount over bin indices offset by nbin + 1
+  per image. Values are assigned to bins by the same edge comparisons as
+  np.histogram and normalized the same way, so the result matches
+  color_histogram_hsv exactly.
+
+  Inputs:
+  - imgs: N x H x W x C array of pixel data for N RGB images.
+  - nbin, xmin, xmax, normalized: As in color_histogram_hsv.
+  - chunk_size: Number of images converted at a time.
+
+  Returns:
+    N x nbin array whose ith row is color_histogram_hsv(imgs[i]).
+  """
+  num_images = imgs.shape[0]
+  bins = np.linspace(xmin, xmax, nbin+1)
+  bin_widths = np.diff(bins)
+  imhist = np.zeros((num_images, nbin))
+  for i in xrange(0, num_images, chunk_size):
+    chunk = imgs[i:i + chunk_size]
+    n = chunk.shape[0]
+    hue = _hue(chunk/xmax).reshape(n, -1) * xmax
+
+    # bin i holds bins[i] <= hue < bins[i + 1], the last bin also hue == xmax;
+    # hues outside [xmin, xmax] go to an extra bin that is dropped
+    idx = np.searchsorted(bins, hue, side='right') - 1
+    idx[hue == bins[-1]] = nbin - 1
+    idx[(hue < bins[0]) | (hue > bins[-1])] = nbin
+    idx += (nbin + 1) * np.arange(n)[:, np.newaxis]
+    counts = np.bincount(idx.ravel(), minlength=n * (nbin + 1))
+    counts = counts.reshape(n, nbin + 1)[:, :nbin]
+
+    if normalized:
+      # the density np.histogram returns, times the bin widths
+      total = np.sum(counts, axis=1, keepdims=True)
+      imhist[i:i + n] = counts / bin_widths / total * bin_widths
+    else:
+      imhist[i:i + n] = counts * bin_widths
+
+  return imhist
+
+
+def _hue(rgb):
+  """
+  Hue channel of matplotlib.colors.rgb_to_hsv for an ... x 3 array of RGB
+  values in [0, 1], with the same operations so that results are identical.
+  """
+  # channel planes and an elementwise max / min are much faster than
+  # reducing over a last axis of length 3, and give the same values
+  red, green, blue = np.rollaxis(rgb, -1).copy()
+  arr_max = np.maximum(np.maximum(red, green), blue)
+  delta = arr_max - np.minimum(np.minimum(red, green), blue)
+  # where several channels are the max, the later one wins as in rgb_to_hsv
+  blue_max = blue == arr_max
+  green_max = (green == arr_max) & ~blue_max
+  offset = np.where(blue_max, 4., np.where(green_max, 2., 0.))
+  numerator = np.where(blue_max, red - green,
+                       np.where(green_max, blue - red, green - blue))
+  with np.errstate(divide='ignore', invalid='ignore'):
+    hue = offset + numerator / delta
+  hue[delta == 0] = 0
+  hue /= 6.0
+  return np.mod(hue, 1.0, out=hue)
+
+
 pass
@@ -0,0 +1,70 @@
+from __future__ import print_function
+
+import multiprocessing
+import os
+
+import numpy as np
+
+from cs231n.classifiers.neural_net import TwoLayerNet
+from cs231n.parallel import shared_npy, spawn_pool
+
+
+def search_two_layer_net(configs, X_train, y_train, X_val, y_val,
+                         num_workers=None, blas_threads=1):
+  """
+  Train one TwoLayerNet per configuration in a pool of worker processes and
+  yield the results as they complete.
+
+  The data arrays reach the workers through parallel.shared_npy, and the
+  workers are started by parallel.spawn_pool with their BLAS thread count
+  pinned to blas_threads.
+
+  Inputs:
+  - configs: A list of dictionaries. Each must contain 'hidden_size' and may
+    contain 'std' (passed to the TwoLayerNet constructor), 'seed' (seeds
+    numpy's RNG in the worker), and any keyword argument of
+    TwoLayerNet.train such as 'learning_rate', 'reg' or 'num_iters'.
+  - X_train, y_train: Training data of shape (N, D) and labels of shape (N,).
+  - X_val, y_val: Validation data and labels.
+  - num_workers: Number of worker processes; defaults to the number of CPUs.
+  - blas_threads: Number of BLAS threads per worker.
+
+  Yields, in order of completion, dictionaries with the keys:
+  - config: The configuration dictionary.
+  - val_acc: Validation accuracy of the trained net.
+  - stats: The dictionary returned by TwoLayerNet.train.
+  - params: The trained net's params dictionary.
+  """
+  if num_workers is None:
+    num_workers = multiprocessing.cpu_count()
+  arrays = {'X_train': X_train, 'y_train': y_train, 'X_val': X_val, 'y_val': y_val}
+  with shared_npy(arrays, prefix='two_layer_net_search_') as data_dir:
+    pool = spawn_pool(num_workers, blas_threads)
+    try:
+      jobs = [(data_dir, config) for config in configs]
+      for result in pool.imap_unordered(_train_config, jobs):
+        yield result
+    finally:
+      pool.terminate()
+      pool.join()
+
+
+def _train_config(args):
+  """ Worker for search_two_layer_net: train and evaluate one config. """
+  data_dir, config = args
+  data = dict((name, np.load(os.path.join(data_dir, name + '.npy'), mmap_mode='r'))
+              for name in ('X_train', 'y_train', 'X_val', 'y_val'))
+  train_kwargs = dict(config)
+  hidden_size = train_kwargs.pop('hidden_size')
+  std = train_kwargs.pop('std', 1e-4)
+  seed = train_kwargs.pop('seed', None)
+  if seed is not None:
+    np.random.seed(seed)
+
+  input_size = data['X_train'].shape[1]
+  num_classes = int(np.max(data['y_train'])) + 1
+  net = TwoLayerNet(input_size, hidden_size, num_classes, std=std)
+  stats = net.train(data['X_train'], data['y_train'], data['X_val'], data['y_val'],
+                    **train_kwargs)
+  val_acc = np.mean(net.predict(data['X_val']) == data['y_val'])
+  return {'config': config, 'val_acc': val_acc, 'stats': stats, 'params': net.params}
@@ -0,0 +1,62 @@
+import contextlib
+import multiprocessing
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# environment variables that cap the thread pools of the common BLAS builds
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def spawn_pool(num_workers, blas_threads=1):
+  """
+  Start a pool of num_workers processes whose BLAS thread count is pinned to
+  blas_threads, so that the workers do not oversubscribe the cores.
+
+  Spawned workers import numpy after starting, so the environment they
+  inherit from here decides the size of their BLAS thread pools; forked
+  workers would inherit the parent's already started pools instead. The
+  environment of the calling process is restored before returning.
+  """
+  saved_env = dict((var, os.environ.get(var)) for var in BLAS_THREAD_VARS)
+  for var in BLAS_THREAD_VARS:
+    os.environ[var] = str(blas_threads)
+  try:
+    return multiprocessing.get_context('spawn').Pool(num_workers)
+  finally:
+    for var, value in saved_env.items():
+      if value is None:
+        del os.environ[var]
+      else:
+        os.environ[var] = value
+
+
+def shared_tmpdir(prefix='cs231n_'):
+  """
+  Create a temporary directory for files that worker processes memory-map,
+  in shared memory (/dev/shm) where it exists so that the files never touch
+  the disk, and return its path. The caller removes it.
+  """
+  shm_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+  return tempfile.mkdtemp(prefix=prefix, dir=shm_dir)
+
+
+@contextlib.contextmanager
+def shared_npy(arrays, prefix='cs231n_'):
+  """
+  Context manager that writes every array of the dictionary arrays to
+  name.npy in a new shared_tmpdir and yields the directory, which is removed
+  on exit. Workers given the directory memory-map the files, so they share
+  the pages instead of each receiving a pickled copy of the arrays.
+  """
+  data_dir = shared_tmpdir(prefix)
+  try:
+    for name, arr in arrays.items():
+      np.save(os.path.join(data_dir, name + '.npy'), arr)
+    yield data_dir
+  finally:
+    shutil.rmtree(data_dir, ignore_errors=True)
@@ -342,21 +342,54 @@ def affine_batchnorm_relu_forward(x, w, b, gamma, beta, bn_param):
     Convenience layer that performs an affine transform followed by batch normalisation,
     followed by a ReLU
 
+    The three layers are fused: the normalisation is done in place on the
+    affine output, and the cache holds only the input, the normalised
+    activations and the inverse standard deviation (besides references to the
+    parameters), instead of the five (N, D) arrays kept by chaining
+    affine_forward, batchnorm_forward and relu_forward. The ReLU mask and the
+    other intermediates are recomputed in the backward pass.
+
     Inputs:
     - x: Input to the affine layer
     - w, b: Weights for the affine layer
     - gamma: scaling factor
     - beta: shifting factor
-    - bn_param: for batch normalisation
+    - bn_param: for batch normalisation, as in batchnorm_forward
 
     Returns a tuple of:
     - out: Output from the ReLU
     - cache: Object to give to the backward pass
     """
-    intermediate_1, fc_cache = affine_forward(x, w, b)
-    intermediate_2, bn_cache = batchnorm_forward(intermediate_1, gamma, beta, bn_param)
-    out, relu_cache = relu_forward(intermediate_2)
-    cache = (fc_cache, bn_cache, relu_cache)
+    mode = bn_param['mode']
+    eps = bn_param.get('eps', 1e-5)
+    momentum = bn_param.get('momentum', 0.9)
+
+    N = x.shape[0]
+    x_hat = np.reshape(x, (N, -1)).dot(w) + b # shape: (N, D)
+    D = x_hat.shape[1]
+    running_mean = bn_param.get('running_mean', np.zeros(D, dtype=x_hat.dtype))
+    running_var = bn_param.get('running_var', np.zeros(D, dtype=x_hat.dtype))
+
+    if mode == 'train':
+        mean = np.sum(x_hat, axis=0) / N
+        x_hat -= mean
+        variance = np.einsum('ij,ij->j', x_hat, x_hat) / N
+        running_mean = momentum * running_mean + (1.0 - momentum) * mean
+        running_var = momentum * running_var + (1.0 - momentum) * variance
+    elif mode == 'test':
+        x_hat -= running_mean
+        variance = running_var
+    else:
+        raise ValueError('Invalid forward batchnorm mode "%s"' % mode)
+    bn_param['running_mean'] = running_mean
+    bn_param['running_var'] = running_var
+
+    inv_std = 1.0 / np.sqrt(variance + eps) # shape: (D, )
+    x_hat *= inv_std
+    out = x_hat * gamma
+    out += beta
+    np.maximum(out, 0, out=out)
+    cache = (x, w, gamma, beta, x_hat, inv_std)
     return out, cache
 
 
@@ -364,10 +397,28 @@ def affine_batchnorm_relu_backward(dout, cache):
     """
     Backward pass for the affine-batchnorm-relu convenience layer
     """
-    fc_cache, bn_cache, relu_cache = cache
-    dintermediate_1 = relu_backward(dout, relu_cache)
-    dintermediate_2, dgamma, dbeta = batchnorm_backward_alt(dintermediate_1, bn_cache)
-    dx, dw, db = affine_backward(dintermediate_2, fc_cache)
+    x, w, gamma, beta, x_hat, inv_std = cache
+    N = dout.shape[0]
+
+    # recompute the input of the ReLU to get its mask
+    dy = x_hat * gamma
+    dy += beta
+    np.multiply(dout, dy > 0, out=dy)
+
+    dbeta = np.sum(dy, axis=0)
+    dgamma = np.einsum('ij,ij->j', dy, x_hat)
+
+    # same as batchnorm_backward_alt, using sum(dxhat) = gamma * dbeta and
+    # sum(dxhat * x_hat) = gamma * dgamma
+    dy *= gamma
+    da = x_hat * (-gamma * dgamma / N)
+    da += dy
+    da -= gamma * dbeta / N
+    da *= inv_std
+
+    dw = np.reshape(x, (N, -1)).T.dot(da)
+    dx = da.dot(w.T).reshape(x.shape)
+    db = np.sum(da, axis=0)
     return dx, dw, db, dgamma, dbeta
 
 def affine_relu_dropout_forward(x, w, b, dropout_param):
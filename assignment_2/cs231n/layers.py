@@ -874,3 +874,63 @@ def softmax_loss(x, y):
     dx[np.arange(N), y] -= 1
     dx /= N
     return loss, dx
+
+
+def svm_loss_fused(x, y, dx=None):
+    """
+    Computes the same loss and gradient as svm_loss, in a single buffer: the
+    margins, the indicator of positive margins and the gradient are all
+    written in place into dx, so no (N, C) temporaries are allocated and the
+    dtype of x is kept (float32 stays float32).
+
+    Inputs:
+    - x: Input data, of shape (N, C) where x[i, j] is the score for the jth
+      class for the ith input.
+    - y: Vector of labels, of shape (N,) where y[i] is the label for x[i] and
+      0 <= y[i] < C
+    - dx: Optional workspace of the same shape and dtype as x, which must not
+      be x itself; it is overwritten and returned as the gradient. If None, a
+      new array is allocated.
+
+    Returns a tuple of:
+    - loss: Scalar giving the loss
+    - dx: Gradient of the loss with respect to x
+    """
+    N = x.shape[0]
+    rows = np.arange(N)
+    if dx is None:
+        dx = np.empty_like(x)
+    np.subtract(x, x[rows, y][:, np.newaxis], out=dx)
+    dx += 1
+    dx[rows, y] = 0
+    np.maximum(dx, 0, out=dx)
+    loss = np.sum(dx) / N
+    # margins are non-negative, so their sign is the indicator margin > 0
+    np.sign(dx, out=dx)
+    dx[rows, y] -= np.sum(dx, axis=1)
+    dx /= N
+    return loss, dx
+
+
+def softmax_loss_fused(x, y, dx=None):
+    """
+    Computes the same loss and gradient as softmax_loss, in a single buffer:
+    the shifted logits, their exponentials and the probabilities are all
+    written in place into dx, so no (N, C) temporaries are allocated and the
+    dtype of x is kept (float32 stays float32).
+
+    Inputs and outputs are the same as svm_loss_fused.
+    """
+    N = x.shape[0]
+    rows = np.arange(N)
+    if dx is None:
+        dx = np.empty_like(x)
+    np.subtract(x, np.max(x, axis=1, keepdims=True), out=dx)
+    correct_logits = dx[rows, y]
+    np.exp(dx, out=dx)
+    Z = np.sum(dx, axis=1)
+    loss = -np.sum(correct_logits - np.log(Z)) / N
+    dx /= Z[:, np.newaxis]
+    dx[rows, y] -= 1
+    dx /= N
+    return loss, dx
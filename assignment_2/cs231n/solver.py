@@ -113,10 +113,28 @@ class Solver(object):
           accuracy; default is None, which uses the entire validation set.
         - checkpoint_name: If not None, then save model checkpoints here every
           epoch.
+        - train_loader: If not None, an object whose next_batch() method
+          returns a tuple (X_batch, y_batch) and whose len() is the number of
+          minibatches in an epoch, such as a data_utils.DataLoader; minibatches
+          are then taken from it instead of being sampled from X_train, and
+          batch_size is not used. If data has no 'X_train' and 'y_train',
+          training accuracy is checked on the first two arrays of
+          train_loader.dataset.
+        - mean_image: If not None, an array of shape (d_1, ..., d_k) that is
+          subtracted from every minibatch before it is passed to the model, so
+          that the data can be kept unnormalized, e.g. as the uint8 images and
+          mean image from get_CIFAR10_data(dtype=np.uint8).
+        - input_dtype: dtype of the minibatches passed to the model when
+          mean_image is given; the subtraction and the conversion to it are
+          done in one pass. Default is np.float64.
         """
         self.model = model
-        self.X_train = data['X_train']
-        self.y_train = data['y_train']
+        self.train_loader = kwargs.pop('train_loader', None)
+        if self.train_loader is not None and 'X_train' not in data:
+            self.X_train, self.y_train = self.train_loader.dataset.arrays[:2]
+        else:
+            self.X_train = data['X_train']
+            self.y_train = data['y_train']
         self.X_val = data['X_val']
         self.y_val = data['y_val']
 
@@ -132,6 +150,10 @@ class Solver(object):
         self.checkpoint_name = kwargs.pop('checkpoint_name', None)
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.input_dtype = kwargs.pop('input_dtype', np.float64)
+        self.mean_image = kwargs.pop('mean_image', None)
+        if self.mean_image is not None:
+            self.mean_image = np.asarray(self.mean_image, dtype=self.input_dtype)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -173,10 +195,14 @@ class Solver(object):
         be called manually.
         """
         # Make a minibatch of training data
-        num_train = self.X_train.shape[0]
-        batch_mask = np.random.choice(num_train, self.batch_size)
-        X_batch = self.X_train[batch_mask]
-        y_batch = self.y_train[batch_mask]
+        if self.train_loader is not None:
+            X_batch, y_batch = self.train_loader.next_batch()
+        else:
+            num_train = self.X_train.shape[0]
+            batch_mask = np.random.choice(num_train, self.batch_size)
+            X_batch = self.X_train[batch_mask]
+            y_batch = self.y_train[batch_mask]
+        X_batch = self._normalize(X_batch)
 
         # Compute loss and gradient
         loss, grads = self.model.loss(X_batch, y_batch)
@@ -191,6 +217,16 @@ class Solver(object):
             self.optim_configs[p] = next_config
 
 
+    def _normalize(self, X):
+        """
+        Subtract mean_image from a minibatch, converting it to input_dtype in
+        the same pass; minibatches are returned unchanged without mean_image.
+        """
+        if self.mean_image is None:
+            return X
+        return np.subtract(X, self.mean_image, dtype=self.input_dtype)
+
+
     def _save_checkpoint(self):
         if self.checkpoint_name is None: return
         checkpoint = {
@@ -246,7 +282,7 @@ class Solver(object):
         for i in range(num_batches):
             start = i * batch_size
             end = (i + 1) * batch_size
-            scores = self.model.loss(X[start:end])
+            scores = self.model.loss(self._normalize(X[start:end]))
             y_pred.append(np.argmax(scores, axis=1))
         y_pred = np.hstack(y_pred)
         acc = np.mean(y_pred == y)
@@ -258,8 +294,11 @@ class Solver(object):
         """
         Run optimization to train the model.
         """
-        num_train = self.X_train.shape[0]
-        iterations_per_epoch = max(num_train // self.batch_size, 1)
+        if self.train_loader is not None:
+            iterations_per_epoch = len(self.train_loader)
+        else:
+            num_train = self.X_train.shape[0]
+            iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
 
         for t in range(num_iterations):
@@ -88,9 +88,15 @@ class CaptioningSolver(object):
           iterations.
         - verbose: Boolean; if set to false then no output will be printed during
           training.
+        - train_loader: If not None, an object whose next_batch() method
+          returns a tuple (captions, features, urls) and whose len() is the
+          number of minibatches in an epoch, such as a data_utils.DataLoader
+          over a coco_utils.CocoDataset; minibatches are then taken from it
+          instead of from sample_coco_minibatch, and batch_size is not used.
         """
         self.model = model
         self.data = data
+        self.train_loader = kwargs.pop('train_loader', None)
 
         # Unpack keyword arguments
         self.update_rule = kwargs.pop('update_rule', 'sgd')
@@ -142,9 +148,12 @@ class CaptioningSolver(object):
         be called manually.
         """
         # Make a minibatch of training data
-        minibatch = sample_coco_minibatch(self.data,
-                      batch_size=self.batch_size,
-                      split='train')
+        if self.train_loader is not None:
+            minibatch = self.train_loader.next_batch()
+        else:
+            minibatch = sample_coco_minibatch(self.data,
+                          batch_size=self.batch_size,
+                          split='train')
         captions, features, urls = minibatch
 
         # Compute loss and gradient
@@ -207,8 +216,11 @@ class CaptioningSolver(object):
         """
         Run optimization to train the model.
         """
-        num_train = self.data['train_captions'].shape[0]
-        iterations_per_epoch = max(num_train // self.batch_size, 1)
+        if self.train_loader is not None:
+            iterations_per_epoch = len(self.train_loader)
+        else:
+            num_train = self.data['train_captions'].shape[0]
+            iterations_per_epoch = max(num_train // self.batch_size, 1)
         num_iterations = self.num_epochs * iterations_per_epoch
 
         for t in range(num_iterations):
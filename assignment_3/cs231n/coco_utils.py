@@ -1,8 +1,11 @@
 from builtins import range
+from builtins import object
 import os, json
 import numpy as np
 import h5py
 
+from cs231n.data_utils import Dataset
+
 BASE_DIR = 'cs231n/datasets/coco_captioning'
 
 def load_coco_data(base_dir=BASE_DIR,
@@ -83,3 +86,22 @@ def sample_coco_minibatch(data, batch_size=100, split='train'):
     image_features = data['%s_features' % split][image_idxs]
     urls = data['%s_urls' % split][image_idxs]
     return captions, image_features, urls
+
+
+class CocoDataset(Dataset):
+    """
+    The captions of one split of the data from load_coco_data as a Dataset,
+    so that a data_utils.DataLoader can iterate over them in epochs. Like
+    sample_coco_minibatch, indexing returns a tuple (captions, image_features,
+    urls), with the features and urls of the image of each caption.
+    """
+
+    def __init__(self, data, split='train'):
+        super(CocoDataset, self).__init__(data['%s_captions' % split],
+                                          data['%s_image_idxs' % split])
+        self.features = data['%s_features' % split]
+        self.urls = data['%s_urls' % split]
+
+    def __getitem__(self, idxs):
+        captions, image_idxs = super(CocoDataset, self).__getitem__(idxs)
+        return captions, self.features[image_idxs], self.urls[image_idxs]
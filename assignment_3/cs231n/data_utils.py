@@ -1,9 +1,14 @@
 from __future__ import print_function
 
 from builtins import range
+from builtins import object
+from multiprocessing.pool import ThreadPool
 from six.moves import cPickle as pickle
+import copy
+import json
 import numpy as np
 import os
+import shutil
 from scipy.misc import imread
 import platform
 
@@ -41,39 +46,125 @@ def load_CIFAR10(ROOT):
     return Xtr, Ytr, Xte, Yte
 
 
+# arrays written by convert_CIFAR10 and memory-mapped by load_CIFAR10_cached
+CIFAR10_ARRAYS = ('X_train', 'y_train', 'X_test', 'y_test', 'mean_image')
+
+
+def convert_CIFAR10(ROOT, cache_dir):
+    """
+    Convert the pickled CIFAR-10 batches in ROOT, once, to .npy files in
+    cache_dir that load_CIFAR10_cached can memory-map:
+    - X_train.npy, X_test.npy: uint8 images of shape (N, 3, 32, 32); this is
+      the layout of the pickled rows, so no transpose is needed
+    - y_train.npy, y_test.npy: int64 labels of shape (N,)
+    - mean_image.npy: float64 mean of all training images, shape (3, 32, 32)
+    Every file is written to a temporary name and renamed into place.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    arrays = dict(zip(CIFAR10_ARRAYS, _load_CIFAR10_raw(ROOT)))
+    arrays['mean_image'] = np.mean(arrays['X_train'], axis=0, dtype=np.float64)
+    for name in CIFAR10_ARRAYS:
+        tmp_path = os.path.join(cache_dir, name + '.tmp.npy')
+        np.save(tmp_path, arrays[name])
+        os.rename(tmp_path, os.path.join(cache_dir, name + '.npy'))
+
+
+def load_CIFAR10_cached(cache_dir, ROOT=None):
+    """
+    Memory-map CIFAR-10 from the .npy files written by convert_CIFAR10,
+    converting from the pickled batches in ROOT first if cache_dir does not
+    hold them yet. Nothing is read until it is used, so this takes
+    milliseconds, and processes mapping the same files share the page cache.
+    Slices of the returned arrays are views into the mapped files.
+
+    Returns a tuple of:
+    - X_train: uint8 array of shape (50000, 3, 32, 32)
+    - y_train: int64 array of shape (50000,)
+    - X_test: uint8 array of shape (10000, 3, 32, 32)
+    - y_test: int64 array of shape (10000,)
+    - mean_image: float64 array of shape (3, 32, 32), the mean training image
+    """
+    paths = [os.path.join(cache_dir, name + '.npy') for name in CIFAR10_ARRAYS]
+    if ROOT is not None and not all(os.path.isfile(p) for p in paths):
+        convert_CIFAR10(ROOT, cache_dir)
+    return tuple(np.load(p, mmap_mode='r') for p in paths)
+
+
+def _load_CIFAR_batch_raw(filename):
+    """ load single batch of cifar as uint8 NCHW images and int64 labels """
+    with open(filename, 'rb') as f:
+        datadict = load_pickle(f)
+        X = np.asarray(datadict['data'], dtype=np.uint8).reshape(-1, 3, 32, 32)
+        Y = np.array(datadict['labels'], dtype=np.int64)
+        return X, Y
+
+
 def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
-                     subtract_mean=True):
+                     subtract_mean=True, dtype=np.float64, cache_dir=None):
     """
     Load the CIFAR-10 dataset from disk and perform preprocessing to prepare
     it for classifiers. These are the same steps as we used for the SVM, but
     condensed to a single function.
+
+    The images are read as uint8 in NCHW layout and cast straight into one
+    preallocated (N, 3, 32, 32) buffer of the requested dtype; the splits are
+    slices of it and the mean image is subtracted in place, so the only large
+    allocation is the returned data itself.
+
+    Inputs:
+    - num_training, num_validation, num_test: Sizes of the splits; validation
+      images follow the training images in the CIFAR-10 training set.
+    - subtract_mean: Whether to subtract the mean training image.
+    - dtype: dtype of the returned images, e.g. np.float32 or np.float16 to
+      use a half or a quarter of the memory of the default float64. With
+      np.uint8 the images are returned as stored, an eighth of the memory,
+      and are not normalized; if subtract_mean is set, data['mean_image']
+      then holds the float64 mean training image, to be passed as the
+      mean_image of a Solver that subtracts it from each minibatch.
+    - cache_dir: If not None, read the images from the .npy cache of
+      load_CIFAR10_cached, converting it first if needed; with np.uint8 the
+      returned images are then slices of the memory-mapped files.
     """
     # Load the raw CIFAR-10 data
     cifar10_dir = 'cs231n/datasets/cifar-10-batches-py'
-    X_train, y_train, X_test, y_test = load_CIFAR10(cifar10_dir)
-
-    # Subsample the data
-    mask = list(range(num_training, num_training + num_validation))
-    X_val = X_train[mask]
-    y_val = y_train[mask]
-    mask = list(range(num_training))
-    X_train = X_train[mask]
-    y_train = y_train[mask]
-    mask = list(range(num_test))
-    X_test = X_test[mask]
-    y_test = y_test[mask]
-
-    # Normalize the data: subtract the mean image
+    if cache_dir is not None:
+        X_train, y_train, X_test, y_test, _ = load_CIFAR10_cached(
+            cache_dir, ROOT=cifar10_dir)
+    else:
+        X_train, y_train, X_test, y_test = _load_CIFAR10_raw(cifar10_dir)
+
+    if np.dtype(dtype) == np.uint8:
+        num_train_val = num_training + num_validation
+        data = {
+          'X_train': X_train[:num_training], 'y_train': y_train[:num_training],
+          'X_val': X_train[num_training:num_train_val],
+          'y_val': y_train[num_training:num_train_val],
+          'X_test': X_test[:num_test], 'y_test': y_test[:num_test],
+        }
+        if subtract_mean:
+            data['mean_image'] = np.mean(data['X_train'], axis=0,
+                                         dtype=np.float64)
+        return data
+
+    # Subsample the data with slices, which are views rather than copies
+    num_train_val = num_training + num_validation
+    data = np.empty((num_train_val + num_test,) + X_train.shape[1:], dtype=dtype)
+    data[:num_train_val] = X_train[:num_train_val]
+    data[num_train_val:] = X_test[:num_test]
+    X_train = data[:num_training]
+    X_val = data[num_training:num_train_val]
+    X_test = data[num_train_val:]
+    y_val = y_train[num_training:num_train_val]
+    y_train = y_train[:num_training]
+    y_test = y_test[:num_test]
+
+    # Normalize the data: subtract the mean image, in place. The mean is
+    # accumulated in float64 and subtracted in float64 before the result is
+    # cast back, so float16 data loses no more precision than it must.
     if subtract_mean:
-        mean_image = np.mean(X_train, axis=0)
-        X_train -= mean_image
-        X_val -= mean_image
-        X_test -= mean_image
-
-    # Transpose so that channels come first
-    X_train = X_train.transpose(0, 3, 1, 2).copy()
-    X_val = X_val.transpose(0, 3, 1, 2).copy()
-    X_test = X_test.transpose(0, 3, 1, 2).copy()
+        mean_image = np.mean(X_train, axis=0, dtype=np.float64)
+        np.subtract(data, mean_image, out=data, casting='unsafe')
 
     # Package data into a dictionary
     return {
@@ -83,16 +174,57 @@ def get_CIFAR10_data(num_training=49000, num_validation=1000, num_test=1000,
     }
 
 
-def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
+def _load_CIFAR10_raw(ROOT):
+    """ load all of cifar as uint8 NCHW images and int64 labels """
+    xs = []
+    ys = []
+    for b in range(1,6):
+        X, Y = _load_CIFAR_batch_raw(os.path.join(ROOT, 'data_batch_%d' % (b, )))
+        xs.append(X)
+        ys.append(Y)
+    Xte, Yte = _load_CIFAR_batch_raw(os.path.join(ROOT, 'test_batch'))
+    return np.concatenate(xs), np.concatenate(ys), Xte, Yte
+
+
+def measure_peak_memory(fn, *args, **kwargs):
+    """
+    Call fn(*args, **kwargs) and return a tuple of its result and the peak
+    number of bytes allocated through Python and numpy during the call, as
+    traced by tracemalloc (Python 3 only).
+    """
+    import tracemalloc
+    tracemalloc.start()
+    try:
+        result = fn(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, peak
+
+
+def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True,
+                       num_workers=None, cache_dir=None):
     """
     Load TinyImageNet. Each of TinyImageNet-100-A, TinyImageNet-100-B, and
     TinyImageNet-200 have the same directory structure, so this can be used
     to load any of them.
 
+    Decoding the JPEGs dominates the time taken; num_workers decodes them in
+    a pool of threads, and cache_dir keeps the decoded images so that it is
+    done once. The cache holds uint8 (N, 3, 64, 64) arrays in .npy files and
+    an index.json with the class ids, class names and test file names; later
+    loads memory-map it instead of reading any image.
+
     Inputs:
     - path: String giving path to the directory to load.
-    - dtype: numpy datatype used to load the data.
+    - dtype: numpy datatype used to load the data. With np.uint8 the images
+      are returned as stored, memory-mapped if cache_dir is given, and the
+      mean is never subtracted; pass mean_image to a Solver to subtract it
+      from each minibatch instead.
     - subtract_mean: Whether to subtract the mean training image.
+    - num_workers: If not None, number of threads decoding images.
+    - cache_dir: If not None, directory of the packed cache; it is written
+      on the first load.
 
     Returns: A dictionary with the following entries:
     - class_names: A list where class_names[i] is a list of strings giving the
@@ -106,6 +238,46 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
       (such as in student code) then y_test will be None.
     - mean_image: (3, 64, 64) array giving mean training image
     """
+    if cache_dir is None:
+        data = _read_tiny_imagenet(path, num_workers)
+    else:
+        if not os.path.isfile(os.path.join(cache_dir, 'index.json')):
+            _write_tiny_imagenet_cache(_read_tiny_imagenet(path, num_workers),
+                                       cache_dir)
+        data = _open_tiny_imagenet_cache(cache_dir)
+
+    X_train = data['X_train'].astype(dtype, copy=False)
+    X_val = data['X_val'].astype(dtype, copy=False)
+    X_test = data['X_test'].astype(dtype, copy=False)
+
+    mean_image = X_train.mean(axis=0)
+    if subtract_mean and np.dtype(dtype) != np.uint8:
+        X_train -= mean_image[None]
+        X_val -= mean_image[None]
+        X_test -= mean_image[None]
+
+    return {
+      'class_names': data['class_names'],
+      'X_train': X_train,
+      'y_train': data['y_train'],
+      'X_val': X_val,
+      'y_val': data['y_val'],
+      'X_test': X_test,
+      'y_test': data['y_test'],
+      'mean_image': mean_image,
+    }
+
+
+# arrays of the TinyImageNet cache; y_test is only present with test labels
+TINY_IMAGENET_ARRAYS = ('X_train', 'y_train', 'X_val', 'y_val', 'X_test', 'y_test')
+
+
+def _read_tiny_imagenet(path, num_workers=None):
+    """
+    Read TinyImageNet from its directory structure. Returns a dictionary with
+    the entries of load_tiny_imagenet other than mean_image, images being
+    uint8, plus wnids (the class ids) and test_files (the test file names).
+    """
     # First load wnids
     with open(os.path.join(path, 'wnids.txt'), 'r') as f:
         wnids = [x.strip() for x in f]
@@ -120,35 +292,20 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
             wnid_to_words[wnid] = [w.strip() for w in words.split(',')]
     class_names = [wnid_to_words[wnid] for wnid in wnids]
 
-    # Next load training data.
-    X_train = []
+    # Next list training data; to figure out the filenames we need to open
+    # the boxes file of every synset
+    train_files = []
     y_train = []
-    for i, wnid in enumerate(wnids):
-        if (i + 1) % 20 == 0:
-            print('loading training data for synset %d / %d'
-                  % (i + 1, len(wnids)))
-        # To figure out the filenames we need to open the boxes file
+    for wnid in wnids:
         boxes_file = os.path.join(path, 'train', wnid, '%s_boxes.txt' % wnid)
         with open(boxes_file, 'r') as f:
             filenames = [x.split('\t')[0] for x in f]
-        num_images = len(filenames)
-
-        X_train_block = np.zeros((num_images, 3, 64, 64), dtype=dtype)
-        y_train_block = wnid_to_label[wnid] * \
-                        np.ones(num_images, dtype=np.int64)
-        for j, img_file in enumerate(filenames):
-            img_file = os.path.join(path, 'train', wnid, 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:
-        ## grayscale file
-                img.shape = (64, 64, 1)
-            X_train_block[j] = img.transpose(2, 0, 1)
-        X_train.append(X_train_block)
-        y_train.append(y_train_block)
-
-    # We need to concatenate all training data
-    X_train = np.concatenate(X_train, axis=0)
-    y_train = np.concatenate(y_train, axis=0)
+        train_files.extend(os.path.join(path, 'train', wnid, 'images', img_file)
+                           for img_file in filenames)
+        y_train.extend([wnid_to_label[wnid]] * len(filenames))
+    print('loading %d training images' % len(train_files))
+    X_train = _read_images(train_files, num_workers)
+    y_train = np.array(y_train, dtype=np.int64)
 
     # Next load validation data
     with open(os.path.join(path, 'val', 'val_annotations.txt'), 'r') as f:
@@ -156,29 +313,17 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
         val_wnids = []
         for line in f:
             img_file, wnid = line.split('\t')[:2]
-            img_files.append(img_file)
+            img_files.append(os.path.join(path, 'val', 'images', img_file))
             val_wnids.append(wnid)
-        num_val = len(img_files)
-        y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
-        X_val = np.zeros((num_val, 3, 64, 64), dtype=dtype)
-        for i, img_file in enumerate(img_files):
-            img_file = os.path.join(path, 'val', 'images', img_file)
-            img = imread(img_file)
-            if img.ndim == 2:
-                img.shape = (64, 64, 1)
-            X_val[i] = img.transpose(2, 0, 1)
+    y_val = np.array([wnid_to_label[wnid] for wnid in val_wnids])
+    X_val = _read_images(img_files, num_workers)
 
     # Next load test images
     # Students won't have test labels, so we need to iterate over files in the
     # images directory.
-    img_files = os.listdir(os.path.join(path, 'test', 'images'))
-    X_test = np.zeros((len(img_files), 3, 64, 64), dtype=dtype)
-    for i, img_file in enumerate(img_files):
-        img_file = os.path.join(path, 'test', 'images', img_file)
-        img = imread(img_file)
-        if img.ndim == 2:
-            img.shape = (64, 64, 1)
-        X_test[i] = img.transpose(2, 0, 1)
+    test_files = os.listdir(os.path.join(path, 'test', 'images'))
+    X_test = _read_images([os.path.join(path, 'test', 'images', img_file)
+                           for img_file in test_files], num_workers)
 
     y_test = None
     y_test_file = os.path.join(path, 'test', 'test_annotations.txt')
@@ -189,28 +334,187 @@ def load_tiny_imagenet(path, dtype=np.float32, subtract_mean=True):
                 line = line.split('\t')
                 img_file_to_wnid[line[0]] = line[1]
         y_test = [wnid_to_label[img_file_to_wnid[img_file]]
-                  for img_file in img_files]
+                  for img_file in test_files]
         y_test = np.array(y_test)
 
-    mean_image = X_train.mean(axis=0)
-    if subtract_mean:
-        X_train -= mean_image[None]
-        X_val -= mean_image[None]
-        X_test -= mean_image[None]
-
     return {
-      'class_names': class_names,
-      'X_train': X_train,
-      'y_train': y_train,
-      'X_val': X_val,
-      'y_val': y_val,
-      'X_test': X_test,
-      'y_test': y_test,
-      'class_names': class_names,
-      'mean_image': mean_image,
+      'wnids': wnids, 'class_names': class_names, 'test_files': test_files,
+      'X_train': X_train, 'y_train': y_train,
+      'X_val': X_val, 'y_val': y_val,
+      'X_test': X_test, 'y_test': y_test,
     }
 
 
+def _read_images(filenames, num_workers=None):
+    """
+    Decode 64x64 images into a uint8 array of shape (N, 3, 64, 64), in a pool
+    of num_workers threads if given; the decoder releases the GIL.
+    """
+    X = np.zeros((len(filenames), 3, 64, 64), dtype=np.uint8)
+
+    def read(i):
+        img = imread(filenames[i])
+        if img.ndim == 2:
+            ## grayscale file
+            img.shape = (64, 64, 1)
+        X[i] = img.transpose(2, 0, 1)
+
+    if num_workers is None:
+        for i in range(len(filenames)):
+            read(i)
+    else:
+        pool = ThreadPool(num_workers)
+        try:
+            pool.map(read, range(len(filenames)), chunksize=256)
+        finally:
+            pool.close()
+            pool.join()
+    return X
+
+
+def _write_tiny_imagenet_cache(data, cache_dir):
+    """
+    Write the result of _read_tiny_imagenet to cache_dir. index.json is
+    written last, so a cache without it is incomplete and gets rewritten.
+    """
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    for name in TINY_IMAGENET_ARRAYS:
+        if data[name] is not None:
+            np.save(os.path.join(cache_dir, name + '.npy'), data[name])
+    index = {'wnids': data['wnids'], 'class_names': data['class_names'],
+             'test_files': data['test_files'],
+             'has_test_labels': data['y_test'] is not None}
+    tmp_path = os.path.join(cache_dir, 'index.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.rename(tmp_path, os.path.join(cache_dir, 'index.json'))
+
+
+def _open_tiny_imagenet_cache(cache_dir):
+    """ Memory-map a cache written by _write_tiny_imagenet_cache. """
+    with open(os.path.join(cache_dir, 'index.json'), 'r') as f:
+        data = json.load(f)
+    for name in TINY_IMAGENET_ARRAYS:
+        if name != 'y_test' or data['has_test_labels']:
+            data[name] = np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+    if not data['has_test_labels']:
+        data['y_test'] = None
+    return data
+
+
+class Dataset(object):
+    """
+    A collection of examples stored as parallel arrays, such as the images and
+    labels of one split. The arrays may be memory-mapped, e.g. those returned
+    by load_CIFAR10_cached, in which case indexing reads only the rows asked
+    for and the dataset can be larger than RAM.
+    """
+
+    def __init__(self, *arrays):
+        """
+        Inputs:
+        - arrays: One or more arrays of the same length N along their first
+          axis; example i is made of row i of each of them.
+        """
+        if len(arrays) == 0:
+            raise ValueError('Dataset needs at least one array')
+        N = arrays[0].shape[0]
+        for a in arrays[1:]:
+            if a.shape[0] != N:
+                raise ValueError('Arrays have different lengths %d and %d'
+                                 % (N, a.shape[0]))
+        self.arrays = arrays
+
+    @classmethod
+    def from_npy(cls, *paths):
+        """ Build a Dataset over memory-mapped .npy files. """
+        return cls(*[np.load(p, mmap_mode='r') for p in paths])
+
+    def __len__(self):
+        return self.arrays[0].shape[0]
+
+    def __getitem__(self, idxs):
+        """
+        Gather the examples at idxs, an array of indices, returning a tuple
+        with one array per array of the dataset. Indices in increasing order
+        make reads from memory-mapped arrays sequential.
+        """
+        return tuple(a[idxs] for a in self.arrays)
+
+
+class DataLoader(object):
+    """
+    Iterates over a Dataset in minibatches. Each epoch visits every example
+    once, in the order of a fresh random permutation; the indices of each
+    minibatch are then sorted, which does not change the minibatch but turns
+    the gather from a memory-mapped array into a forward scan of the file.
+
+    Iterating over a DataLoader yields the minibatches of one epoch, and
+    next_batch() returns minibatches forever, starting a new epoch whenever
+    one runs out; this is the interface Solver uses for its train_loader.
+
+    Example usage:
+
+    X_train, y_train, _, _, _ = load_CIFAR10_cached(cache_dir)
+    loader = DataLoader(Dataset(X_train, y_train), batch_size=100)
+    for X_batch, y_batch in loader:
+        ...
+    """
+
+    def __init__(self, dataset, batch_size=100, shuffle=True, drop_last=False,
+                 sort_indices=True, seed=None):
+        """
+        Inputs:
+        - dataset: A Dataset, or any object with __len__ and a __getitem__
+          that takes an array of indices.
+        - batch_size: Number of examples per minibatch.
+        - shuffle: If False, visit the examples in order.
+        - drop_last: If True, skip the last minibatch of an epoch when it has
+          fewer than batch_size examples.
+        - sort_indices: Whether to sort the indices of each minibatch.
+        - seed: If not None, seed for a private random number generator;
+          otherwise the global numpy generator is used.
+        """
+        if batch_size < 1:
+            raise ValueError('batch_size must be positive, got %d' % batch_size)
+        if drop_last and len(dataset) < batch_size:
+            raise ValueError('Dataset of %d examples has no full minibatch of %d'
+                             % (len(dataset), batch_size))
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.sort_indices = sort_indices
+        self.rng = np.random if seed is None else np.random.RandomState(seed)
+        self._batches = None
+
+    def __len__(self):
+        """ Number of minibatches in one epoch. """
+        N = len(self.dataset)
+        if self.drop_last:
+            return N // self.batch_size
+        return (N + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        N = len(self.dataset)
+        order = self.rng.permutation(N) if self.shuffle else np.arange(N)
+        for i in range(len(self)):
+            idxs = order[i * self.batch_size:(i + 1) * self.batch_size]
+            if self.sort_indices:
+                idxs = np.sort(idxs)
+            yield self.dataset[idxs]
+
+    def next_batch(self):
+        """ Return the next minibatch, starting a new epoch if needed. """
+        if self._batches is not None:
+            batch = next(self._batches, None)
+            if batch is not None:
+                return batch
+        self._batches = iter(self)
+        return next(self._batches)
+
+
 def load_models(models_dir):
     """
     Load saved models from disk. This will attempt to unpickle all files in a
@@ -223,6 +527,9 @@ def load_models(models_dir):
 
     Returns:
     A dictionary mapping model file names to models.
+
+    This reads every file in full; ModelRegistry reads only their metadata
+    and loads the models on demand.
     """
     models = {}
     for model_file in os.listdir(models_dir):
@@ -234,6 +541,181 @@ def load_models(models_dir):
     return models
 
 
+class ModelRegistry(object):
+    """
+    A lazy alternative to load_models. Constructing a registry reads only the
+    metadata of the models in a directory: the architecture, and for Solver
+    checkpoints the epoch and validation accuracy. A model is unpickled the
+    first time it is looked up, so the best of many checkpoints can be picked
+    without loading the others.
+
+    Pickles cannot be read partially, so the metadata comes from unpickling
+    each file once. With a cache_dir the metadata is kept in an index there,
+    invalidated by the size and mtime of each model file, and every model is
+    split into a pickle of the model without its parameters and one .npy file
+    per parameter. Later registries over the same directory then open only
+    the index, and lookups memory-map the parameters copy-on-write, so that
+    update rules can still modify them in place without touching the cache.
+
+    Example usage:
+
+    registry = ModelRegistry('checkpoints', cache_dir='checkpoints_cache')
+    model = registry[registry.best('val_acc')]
+    """
+
+    def __init__(self, models_dir, cache_dir=None):
+        """
+        Inputs:
+        - models_dir: String giving the path to a directory containing model
+          files in the format of load_models; files that are not pickles
+          (such as README.txt) are skipped.
+        - cache_dir: If not None, directory holding the index and the split
+          models; it is created or brought up to date here.
+        """
+        self.models_dir = models_dir
+        self.cache_dir = cache_dir
+        self.metadata = self._scan()
+        self._models = {}
+
+    def __len__(self):
+        return len(self.metadata)
+
+    def __iter__(self):
+        return iter(sorted(self.metadata))
+
+    def __contains__(self, name):
+        return name in self.metadata
+
+    def keys(self):
+        return sorted(self.metadata)
+
+    def __getitem__(self, name):
+        """ Return the model saved in the file name, loading it if needed. """
+        if name not in self.metadata:
+            raise KeyError(name)
+        if name not in self._models:
+            if self.cache_dir is None:
+                with open(os.path.join(self.models_dir, name), 'rb') as f:
+                    model = load_pickle(f)['model']
+            else:
+                model = self._load_split(name)
+            self._models[name] = model
+        return self._models[name]
+
+    def best(self, key='val_acc'):
+        """
+        Return the name of the model with the largest value of the metadata
+        field key, ignoring models that do not have it.
+        """
+        names = [n for n in self.metadata if self.metadata[n].get(key) is not None]
+        if len(names) == 0:
+            raise ValueError('No model has metadata "%s"' % key)
+        return max(sorted(names), key=lambda n: self.metadata[n][key])
+
+    def _scan(self):
+        """
+        Return a dictionary mapping the names of the model files to their
+        metadata, reading the files that the index does not cover yet.
+        """
+        index = {}
+        index_path = None
+        if self.cache_dir is not None:
+            index_path = os.path.join(self.cache_dir, 'index.json')
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            if os.path.isfile(index_path):
+                with open(index_path, 'r') as f:
+                    index = json.load(f)
+
+        changed = False
+        new_index = {}
+        for model_file in sorted(os.listdir(self.models_dir)):
+            path = os.path.join(self.models_dir, model_file)
+            if not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entry = index.get(model_file)
+            if (entry is None or entry['size'] != stat.st_size
+                    or entry['mtime'] != stat.st_mtime):
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime,
+                         'metadata': self._read_model(model_file)}
+                changed = True
+            new_index[model_file] = entry
+        if index_path is not None:
+            for model_file in set(index) - set(new_index):
+                self._remove_split(model_file)
+                changed = True
+            if changed:
+                tmp_path = index_path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    json.dump(new_index, f)
+                os.rename(tmp_path, index_path)
+        return dict((k, v['metadata']) for k, v in new_index.items()
+                    if v['metadata'] is not None)
+
+    def _read_model(self, model_file):
+        """
+        Unpickle a model file and return its metadata, or None if it is not a
+        model file; with a cache_dir the model is split into it as well.
+        """
+        with open(os.path.join(self.models_dir, model_file), 'rb') as f:
+            try:
+                checkpoint = load_pickle(f)
+                model = checkpoint['model']
+            except (pickle.UnpicklingError, EOFError, TypeError, KeyError):
+                return None
+        params = getattr(model, 'params', None)
+        if not isinstance(params, dict):
+            params = {}
+        val_acc_history = checkpoint.get('val_acc_history')
+        metadata = {
+          'architecture': type(model).__name__,
+          'param_shapes': dict((k, list(np.shape(v))) for k, v in params.items()),
+          'epoch': checkpoint.get('epoch'),
+          'val_acc': float(val_acc_history[-1]) if val_acc_history else None,
+        }
+        if self.cache_dir is not None:
+            self._write_split(model_file, model, params)
+        return metadata
+
+    def _split_dir(self, model_file):
+        return os.path.join(self.cache_dir, 'models', model_file)
+
+    def _write_split(self, model_file, model, params):
+        """
+        Save the parameters of model as .npy files and the rest of it as a
+        pickle, in a directory of cache_dir named after the model file.
+        """
+        self._remove_split(model_file)
+        split_dir = self._split_dir(model_file)
+        os.makedirs(split_dir)
+        for k, v in params.items():
+            np.save(os.path.join(split_dir, k + '.npy'), v)
+        stripped = copy.copy(model)
+        if params:
+            stripped.params = {}
+        with open(os.path.join(split_dir, 'model.pkl'), 'wb') as f:
+            pickle.dump({'model': stripped, 'params': sorted(params)}, f,
+                        protocol=2)
+
+    def _load_split(self, model_file):
+        """ Load a model written by _write_split, memory-mapping its params. """
+        split_dir = self._split_dir(model_file)
+        with open(os.path.join(split_dir, 'model.pkl'), 'rb') as f:
+            split = load_pickle(f)
+        model = split['model']
+        if split['params']:
+            model.params = dict((k, np.load(os.path.join(split_dir, k + '.npy'),
+                                            mmap_mode='c'))
+                                for k in split['params'])
+        return model
+
+    def _remove_split(self, model_file):
+        split_dir = self._split_dir(model_file)
+        if os.path.isdir(split_dir):
+            shutil.rmtree(split_dir)
+
+
 def load_imagenet_val(num=None):
     """Load a handful of validation images from ImageNet.
 
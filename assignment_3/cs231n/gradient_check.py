@@ -5,6 +5,9 @@ from past.builtins import xrange
 import numpy as np
 from random import randrange
 
+from cs231n.parallel import spawn_pool
+
+
 def eval_numerical_gradient(f, x, verbose=True, h=0.00001):
     """
     a naive implementation of numerical gradient of f at x
@@ -58,6 +61,93 @@ def eval_numerical_gradient_array(f, x, df, h=1e-5):
     return grad
 
 
+def eval_numerical_gradient_batched(f, x, df=None, h=1e-5, batch_size=32,
+                                    num_workers=None):
+    """
+    Evaluate a numeric gradient by perturbing many elements of x per call.
+
+    f must accept a leading batch axis: given an array of shape (B,) + x.shape
+    holding B perturbed copies of x, it returns an array of shape (B,) for a
+    scalar function or (B,) + out.shape for an array-valued one. Every call
+    evaluates x + h and x - h for batch_size elements, so f is called about
+    x.size / batch_size times instead of 2 * x.size times.
+
+    For functions without a batch axis, set num_workers instead: the elements
+    of x are then split across a pool of worker processes that each perturb
+    one element at a time. f must then be picklable, e.g. a function defined
+    at module level or a functools.partial of one.
+
+    Inputs:
+    - f: function, see above
+    - x: point (numpy array) to evaluate the gradient at; it is not modified
+    - df: upstream gradient for an array-valued f, as in
+      eval_numerical_gradient_array; None for a scalar f, as in
+      eval_numerical_gradient
+    - h: step size
+    - batch_size: number of elements of x perturbed per call of f
+    - num_workers: if not None, use a pool of this many processes
+
+    Returns:
+    - grad: numeric gradient of the same shape as x, computed with the same
+      arithmetic as eval_numerical_gradient or eval_numerical_gradient_array
+    """
+    if num_workers is not None:
+        return _eval_numerical_gradient_pool(f, x, df, h, num_workers)
+
+    grad = np.zeros_like(x)
+    flat_x = x.reshape(-1)
+    for start in range(0, x.size, batch_size):
+        idx = np.arange(start, min(start + batch_size, x.size))
+        b = idx.size
+        rows = np.arange(b)
+        # rows [0, b) hold x + h and rows [b, 2b) x - h at element idx[row]
+        xs = np.repeat(flat_x[np.newaxis], 2 * b, axis=0)
+        xs[rows, idx] = flat_x[idx] + h
+        xs[b + rows, idx] = flat_x[idx] - h
+        out = f(xs.reshape((2 * b,) + x.shape))
+        for j in rows:
+            grad.flat[idx[j]] = _central_difference(out[j], out[b + j], df, h)
+    return grad
+
+
+def _eval_numerical_gradient_pool(f, x, df, h, num_workers):
+    chunks = np.array_split(np.arange(x.size), num_workers)
+    pool = spawn_pool(num_workers)
+    try:
+        values = pool.map(_numerical_gradient_chunk,
+                          [(f, x, df, h, idx) for idx in chunks])
+    finally:
+        pool.close()
+        pool.join()
+    grad = np.zeros_like(x)
+    for idx, chunk_values in zip(chunks, values):
+        grad.flat[idx] = chunk_values
+    return grad
+
+
+def _numerical_gradient_chunk(args):
+    """ Worker for eval_numerical_gradient_batched: one element at a time. """
+    f, x, df, h, idx = args
+    x = x.copy()
+    values = np.zeros(idx.size, dtype=x.dtype)
+    for j, i in enumerate(idx):
+        ix = np.unravel_index(i, x.shape)
+        oldval = x[ix]
+        x[ix] = oldval + h
+        pos = np.copy(f(x))
+        x[ix] = oldval - h
+        neg = np.copy(f(x))
+        x[ix] = oldval
+        values[j] = _central_difference(pos, neg, df, h)
+    return values
+
+
+def _central_difference(pos, neg, df, h):
+    if df is None:
+        return (pos - neg) / (2 * h)
+    return np.sum((pos - neg) * df) / (2 * h)
+
+
 def eval_numerical_gradient_blobs(f, inputs, output, h=1e-5):
     """
     Compute numeric gradients for a function that operates on input
@@ -127,3 +217,81 @@ def grad_check_sparse(f, x, analytic_grad, num_checks=10, h=1e-5):
                     (abs(grad_numerical) + abs(grad_analytic)))
         print('numerical: %f analytic: %f, relative error: %e'
               %(grad_numerical, grad_analytic, rel_error))
+
+
+def grad_check_model(model, X, y, num_checks=10, h=1e-5, num_workers=None,
+                     seed=0, verbose=True):
+    """
+    Check the analytic gradients of a whole model, such as a FullyConnectedNet
+    or a CaptioningRNN, against central differences at num_checks randomly
+    sampled coordinates of every parameter tensor.
+
+    With num_workers set, the sampled coordinates are split across a pool of
+    worker processes; every worker unpickles its own copy of the model, so
+    the copies can be perturbed independently.
+
+    Inputs:
+    - model: object with a params dictionary and a loss(X, y) method that
+      returns a tuple of the loss and a dictionary of gradients parallel to
+      params; it should be deterministic, e.g. with a fixed dropout seed
+    - X, y: arguments passed to model.loss, e.g. features and captions
+    - num_checks: number of coordinates sampled per parameter tensor; all of
+      them for tensors with fewer elements
+    - h: step size
+    - num_workers: if not None, use a pool of this many processes
+    - seed: seed of the coordinate sampling
+    - verbose: if true, print the max relative error of every tensor
+
+    Returns:
+    - errors: dictionary mapping every parameter name to the max relative
+      error over its sampled coordinates
+    """
+    _, grads = model.loss(X, y)
+    rng = np.random.RandomState(seed)
+    coords = []
+    for name in sorted(model.params):
+        size = model.params[name].size
+        idx = rng.choice(size, min(num_checks, size), replace=False)
+        coords.extend((name, i) for i in idx)
+
+    if num_workers is None:
+        numeric = _model_numerical_gradient((model, X, y, coords, h))
+    else:
+        chunks = [coords[i::num_workers] for i in range(num_workers)]
+        pool = spawn_pool(num_workers)
+        try:
+            results = pool.map(_model_numerical_gradient,
+                               [(model, X, y, chunk, h) for chunk in chunks])
+        finally:
+            pool.close()
+            pool.join()
+        numeric = [None] * len(coords)
+        for i, result in enumerate(results):
+            numeric[i::num_workers] = result
+
+    errors = {}
+    for (name, i), grad_numerical in zip(coords, numeric):
+        grad_analytic = grads[name].flat[i]
+        rel_error = (abs(grad_numerical - grad_analytic) /
+                     max(1e-8, abs(grad_numerical) + abs(grad_analytic)))
+        errors[name] = max(errors.get(name, 0.0), rel_error)
+    if verbose:
+        for name in sorted(errors):
+            print('%s max relative error: %e' % (name, errors[name]))
+    return errors
+
+
+def _model_numerical_gradient(args):
+    """ Central differences of model.loss at (parameter name, flat index) pairs. """
+    model, X, y, coords, h = args
+    values = []
+    for name, i in coords:
+        param = model.params[name]
+        oldval = param.flat[i]
+        param.flat[i] = oldval + h
+        fxph = model.loss(X, y)[0]
+        param.flat[i] = oldval - h
+        fxmh = model.loss(X, y)[0]
+        param.flat[i] = oldval
+        values.append((fxph - fxmh) / (2 * h))
+    return values
@@ -0,0 +1,30 @@
+import multiprocessing
+import os
+
+
+# environment variables that cap the thread pools of the common BLAS builds
+BLAS_THREAD_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS',
+                    'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+
+def spawn_pool(num_workers, blas_threads=1):
+    """
+    Start a pool of num_workers processes whose BLAS thread count is pinned to
+    blas_threads, so that the workers do not oversubscribe the cores.
+
+    Spawned workers import numpy after starting, so the environment they
+    inherit from here decides the size of their BLAS thread pools; forked
+    workers would inherit the parent's already started pools instead. The
+    environment of the calling process is restored before returning.
+    """
+    saved_env = dict((var, os.environ.get(var)) for var in BLAS_THREAD_VARS)
+    for var in BLAS_THREAD_VARS:
+        os.environ[var] = str(blas_threads)
+    try:
+        return multiprocessing.get_context('spawn').Pool(num_workers)
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                del os.environ[var]
+            else:
+                os.environ[var] = value